@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+"""
+Provide a single-process alternative to the Middleman and its agents.
+
+The Legifrance connection, the parsing and the database are driven from one
+asyncio event loop. The blocking calls are run in executors: one thread for
+Legifrance, one thread for the database and either a thread or a pool of
+processes for the parsing. Nothing is pickled between processes unless parsing
+workers are requested, so short runs start instantly, work from an IDE and
+are easy to profile.
+
+Classes
+-------
+AsyncCrawler
+    Crawl Legifrance and store the parsed texts from an event loop.
+
+Methods
+-------
+crawl
+    Crawl Legifrance and store the parsed texts, from the current process.
+crawlAsync
+    Coroutine crawling Legifrance and storing the parsed texts.
+"""
+import asyncio, time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dbStructure import Types
+from knownCids import KnownCids
+from inFlight import InFlightTracker, States
+from scheduler import Scheduler
+from sinks import Sink, PostgresSink
+from converter import _createConnector, _getTextIdPage, _getText, \
+    _filterLegiText, _parseText, _mergeArticles, _filterFingerprint, \
+    _insertTexts, _readCompletedWindows, _isCompleted, _recordCompletedWindow
+
+def crawl(args, storage, orders, parseWorkers=0, batchSize=1,
+          maxInFlight=None, windowPages=5, windowState=None, pageSize=None,
+          trace=False, reparse=False, cassette=None):
+    """
+    Crawl Legifrance and store the parsed texts, from the current process.
+
+    This method is blocking and returns when all the orders are completed.
+    It runs its own event loop, hence it MUST NOT be called from a running
+    event loop, such as those of IPython, Jupyter or Spyder consoles: the
+    crawlAsync coroutine MUST be awaited there instead.
+    The parameters have the same meaning as those of createTextProvider,
+    createDbManager and Middleman.create.
+
+    Parameters
+    ----------
+    args : tuple
+        Arguments to create the connection to Legifrance, see
+        createTextProvider.
+    storage : tuple or Sink
+        Arguments to create a DbConnector object, or Sink object in which the
+        results will be stored.
+    orders : iterable
+        Each element is either a SearchFilters object, to retrieve all its
+        texts, or a tuple (SearchFilters object, (start, end)) to retrieve the
+        texts published between the dates start and end, included, as
+        "YYYY-MM-DD" str.
+    parseWorkers : int, optional
+        Number of worker processes parsing the texts. If 0, the texts are
+        parsed in a thread. The default is 0.
+    batchSize : int, optional
+        Number of parsed texts stored at once. The default is 1.
+    maxInFlight : int, optional
+        Maximum number of texts requested from Legifrance and not yet stored.
+        If None, there is no limit. The default is None.
+    windowPages : int, optional
+        Maximum number of pages of search results per window of publication
+        dates, above which the window is split. The default is 5.
+    windowState : str, optional
+        Path to the file listing the completed windows of publication dates.
+        The default is None.
+    pageSize : int, optional
+        Number of CIDs per page of search results. If None, the page size of
+        each filter is used. The default is None.
+    trace : bool or str, optional
+        Tracing of the queries to Legifrance, see createTextProvider.
+        The default is False.
+    reparse : bool, optional
+        If True, Legifrance is not searched: the texts of the filters of the
+        orders that were parsed with other versions of the structures of 
+        their filter (see Sink.staleTexts) are downloaded, parsed and stored 
+        again in place of their previous results. The windows of the orders
+        are ignored. The default is False.
+    cassette : Cassette, optional
+        Cassette recording or replaying the queries to Legifrance, see 
+        createTextProvider. The default is None.
+
+    Returns
+    -------
+    None.
+    """
+    asyncio.run(crawlAsync(args, storage, orders, parseWorkers, batchSize,
+                           maxInFlight, windowPages, windowState, pageSize,
+                           trace, reparse, cassette))
+
+async def crawlAsync(args, storage, orders, parseWorkers=0, batchSize=1,
+                     maxInFlight=None, windowPages=5, windowState=None, 
+                     pageSize=None, trace=False, reparse=False, 
+                     cassette=None):
+    """
+    Coroutine crawling Legifrance and storing the parsed texts.
+
+    This coroutine MAY be awaited from a running event loop, e.g. with
+    "await crawlAsync(...)" in an IPython or Spyder console. Its parameters
+    are those of crawl.
+
+    Returns
+    -------
+    None.
+    """
+    sink = storage if isinstance(storage, Sink) else PostgresSink(*storage)
+    crawler = AsyncCrawler(args, sink, parseWorkers, batchSize, maxInFlight,
+                           windowPages, windowState, pageSize, trace, 
+                           cassette)
+    await crawler.run(orders, reparse)
+
+class AsyncCrawler:
+    """
+    Crawl Legifrance and store the parsed texts from an event loop.
+
+    The crawler follows the same rules as the Middleman: a Scheduler decides
+    what to request from Legifrance, the CIDs are checked against the snapshot
+    of the known CIDs then the database, and the parsed texts are stored in
+    batches. Each blocking operation is a task of the event loop returning a
+    tuple (name, results...), handled by the method _handle<name> when it
+    completes.
+
+    The crawler MAY be kept open to run several jobs in a row: the connection
+    to Legifrance, the sink, the parsing workers and the snapshot of the known
+    CIDs are then reused from one job to the next.
+
+    Methods
+    -------
+    run(orders, reparse)
+        Complete the input orders.
+    open(), close()
+        Set up and release the connections and the executors.
+    runJob(orders, reparse, progress)
+        Complete the input orders with an open crawler.
+    """
+    #Seconds between two progress reports
+    _PROGRESS_PERIOD = 1
+    #Seconds after which the connection to Legifrance is renewed between jobs
+    _CONNECTOR_LIFETIME = 3000
+    def __init__(self, args, sink, parseWorkers=0, batchSize=1,
+                 maxInFlight=None, windowPages=5, windowState=None,
+                 pageSize=None, trace=False, cassette=None):
+        """
+        Create a crawler ready to run. See crawl for the parameters.
+        """
+        self._args = args
+        self._sink = sink
+        self._parseWorkers = parseWorkers
+        self._batchSize = batchSize
+        self._pageSize = pageSize
+        self._trace = trace
+        self._cassette = cassette
+        self._maxInFlight = maxInFlight
+        self._windowPages = windowPages
+        self._windowState = windowState
+        self._completed = _readCompletedWindows(windowState)
+        self._known = None
+        #Executors of the blocking calls, by role
+        self._executors = dict()
+        self._connector = None
+        self._connectedAt = None
+        self._tracer = None
+        self._reset()
+
+    def _reset(self):
+        """Prepare the state of a new job."""
+        self._scheduler = Scheduler(lookahead=max(20, self._batchSize),
+                                    maxInFlight=self._maxInFlight,
+                                    windowPages=self._windowPages)
+        #Searches with no more page to fetch
+        self._paginated = set()
+        #Search and state of the CIDs being checked or processed
+        self._inFlight = InFlightTracker()
+        self._parsing = 0
+        self._parsed = []
+        #True iff the stored texts replace previous results
+        self._replace = False
+        self._tasks = set()
+        #Counters reported as progress
+        self._pages = 0
+        self._stored = 0
+
+    async def _call(self, executor, function, *args):
+        """Run a blocking function in an executor."""
+        return await asyncio.get_running_loop().run_in_executor(executor,
+                                                                function, 
+                                                                *args)
+
+    async def run(self, orders, reparse=False):
+        """
+        Complete the input orders.
+
+        Parameters
+        ----------
+        orders : iterable
+            Orders as described in crawl.
+        reparse : bool, optional
+            Reparsing mode as described in crawl. The default is False.
+
+        Returns
+        -------
+        None.
+        """
+        await self.open()
+        try:
+            await self.runJob(orders, reparse)
+        finally:
+            await self.close()
+            print(self._inFlight.summary())
+
+    async def open(self):
+        """
+        Set up the executors and the connections to Legifrance and the sink.
+
+        Returns
+        -------
+        None.
+        """
+        if self._parseWorkers:
+            parse = ProcessPoolExecutor(self._parseWorkers)
+        else:
+            parse = ThreadPoolExecutor(1)
+        self._executors = {"legi": ThreadPoolExecutor(1),
+                           "db": ThreadPoolExecutor(1), "parse": parse}
+        await self._connect()
+        await self._call(self._executors["db"], self._sink.__enter__)
+        cids = await self._call(self._executors["db"], self._sink.knownCids)
+        if cids is not None:
+            self._known = KnownCids(cids)
+
+    async def _connect(self):
+        """Create the connection to Legifrance."""
+        self._connector, self._tracer = await self._call(
+            self._executors["legi"], _createConnector, self._args, 
+            self._trace, self._cassette)
+        self._connectedAt = time.time()
+
+    async def close(self):
+        """
+        Release the connections and the executors.
+
+        Returns
+        -------
+        None.
+        """
+        try:
+            await self._call(self._executors["db"], self._sink.__exit__, 
+                             None, None, None)
+        finally:
+            for executor in self._executors.values():
+                executor.shutdown()
+            if self._tracer is not None:
+                self._tracer.close()
+                print(self._tracer.summary())
+            if self._cassette is not None:
+                self._cassette.close()
+
+    async def runJob(self, orders, reparse=False, progress=None):
+        """
+        Complete the input orders with an open crawler.
+
+        Parameters
+        ----------
+        orders : iterable
+            Orders as described in crawl.
+        reparse : bool, optional
+            Reparsing mode as described in crawl. The default is False.
+        progress : function, optional
+            If provided, it is called regularly during the job, and once at
+            its end, with a dict describing the progress of the job (see
+            progress). The default is None.
+
+        Raises
+        ------
+        Exception
+            Any error that stopped the job. The pending tasks are then
+            cancelled and the sink is reopened, discarding its uncommitted
+            changes, so that the crawler MAY run other jobs.
+
+        Returns
+        -------
+        None.
+        """
+        self._reset()
+        if time.time() - self._connectedAt > self._CONNECTOR_LIFETIME:
+            #The OAuth token is not renewed by the connector
+            if self._tracer is not None:
+                self._tracer.close()
+            await self._connect()
+        try:
+            if reparse:
+                await self._queueStale(orders)
+            else:
+                for order in orders:
+                    if isinstance(order, tuple):
+                        self._addSearch(order[0], tuple(order[1]))
+                    else:
+                        self._addSearch(order, None)
+            await self._loop(progress)
+            #The results of the job are durable once it is reported as done
+            await self._call(self._executors["db"], self._sink.flush)
+        except Exception as e:
+            await self._abort(e)
+            raise
+        if progress is not None:
+            progress(self.progress())
+
+    async def _abort(self, error):
+        """Cancel the tasks of a failed job and reopen the sink."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = set()
+        #The blocking calls already started cannot be cancelled: wait for 
+        #them, the executors running one call at a time
+        for role in ("legi", "db"):
+            await self._call(self._executors[role], lambda: None)
+        #Reopening the sink rolls back an aborted transaction
+        await self._call(self._executors["db"], self._sink.__exit__, 
+                         type(error), error, error.__traceback__)
+        await self._call(self._executors["db"], self._sink.__enter__)
+
+    def progress(self):
+        """
+        Describe the progress of the current or last job.
+
+        Returns
+        -------
+        dict
+            Number of pages of search results received ("pages") and of texts
+            stored ("stored"), along with the metrics of the in-flight CIDs
+            (see InFlightTracker.metrics).
+        """
+        result = self._inFlight.metrics()
+        result.update(pages=self._pages, stored=self._stored)
+        return result
+
+    async def _queueStale(self, orders):
+        """Queue the download of the stale texts of the filters of orders."""
+        filters = {x.name: x for x in 
+                   (y[0] if isinstance(y, tuple) else y for y in orders)}
+        stale = await self._call(self._executors["db"], self._sink.staleTexts,
+                                 {name: _filterFingerprint(criteria) 
+                                  for name, criteria in filters.items()})
+        self._replace = True
+        for criteria in filters.values():
+            self._inFlight.addSearch((criteria, None))
+            self._paginated.add((criteria, None))
+        for cid, name in stale:
+            self._inFlight.track(cid, (filters[name], None))
+        self._scheduler.addDownloads([x[0] for x in stale])
+        print(str(len(stale)) + " texts to parse again")
+
+    async def _loop(self, progress=None):
+        """Start tasks and handle their results until all is done."""
+        self._schedule()
+        reported = time.time()
+        while self._tasks:
+            if progress is not None and \
+                    time.time() - reported >= self._PROGRESS_PERIOD:
+                progress(self.progress())
+                reported = time.time()
+            done = (await asyncio.wait(
+                self._tasks, return_when=asyncio.FIRST_COMPLETED))[0]
+            for task in done:
+                #The tasks not handled yet are cancelled if a task failed
+                self._tasks.remove(task)
+                result = task.result()
+                getattr(self, "_handle" + result[0])(*result[1:])
+            if self._parsed and not (self._scheduler.expectsTexts()
+                                     or self._parsing):
+                self._flushParsed()
+            self._schedule()
+
+    def _start(self, coroutine):
+        """Register a task of the event loop."""
+        self._tasks.add(asyncio.ensure_future(coroutine))
+
+    def _addSearch(self, criteria, window):
+        """Register a search, unless its window is already completed."""
+        if _isCompleted(self._completed, criteria, window):
+            return None
+        self._inFlight.addSearch((criteria, window))
+        self._scheduler.addSearch(criteria, window)
+
+    def _updateSearch(self, search, done=0):
+        """
+        Record that done CIDs of a search are processed, and check if the
+        search is complete.
+        """
+        self._inFlight.done(search, done)
+        if search in self._paginated and not self._inFlight.pending(search):
+            self._paginated.remove(search)
+            _recordCompletedWindow(self._windowState, self._completed, search)
+
+    def _schedule(self):
+        """Start the requests to Legifrance chosen by the scheduler."""
+        request = self._scheduler.next()
+        while request is not None:
+            if request[0] == "page":
+                self._start(self._fetchPage(*request[1:]))
+            else:
+                self._inFlight.move(request[1], States.DOWNLOADING)
+                self._start(self._fetchText(request[1]))
+            request = self._scheduler.next()
+
+    async def _fetchPage(self, criteria, page, window):
+        """Fetch a page of search results."""
+        cids, isLast, total = await self._call(
+            self._executors["legi"], _getTextIdPage, self._connector,
+            criteria, page, self._pageSize, window)
+        return ("Page", criteria, window, cids, isLast, total)
+
+    def _handlePage(self, criteria, window, cids, isLast, total):
+        """React to a page of search results."""
+        self._pages += 1
+        search = (criteria, window)
+        split = self._scheduler.pageDone(criteria, window, isLast, total,
+                                         len(cids))
+        if split is not None:
+            #The window is too large: search its halves instead
+            for half in split:
+                self._addSearch(criteria, half)
+            return None
+        #Skip the CIDs already being processed by another search
+        cids = [x for x in cids if x not in self._inFlight]
+        if self._known is not None:
+            cids = self._known.unknown(cids)
+        if isLast:
+            self._paginated.add(search)
+        if not cids:
+            self._updateSearch(search)
+            return None
+        self._scheduler.checkStarted(len(cids))
+        self._start(self._check(self._inFlight.startCheck(search, len(cids)),
+                                cids))
+
+    async def _check(self, requestId, cids):
+        """Check which CIDs are already stored in the database."""
+        known = await self._call(self._executors["db"],
+                                 lambda: [self._sink.isKnown(x) for x in cids])
+        return ("Check", requestId, cids, known)
+
+    def _handleCheck(self, requestId, cids, known):
+        """React to the check of CIDs by the database."""
+        search, checked = self._inFlight.endCheck(requestId)
+        self._scheduler.checkDone(checked)
+        #Skip the CIDs that another search started processing since
+        unknown = [cid for cid, isKnown in zip(cids, known) 
+                   if not isKnown and cid not in self._inFlight]
+        for cid in unknown:
+            self._inFlight.track(cid, search)
+        self._scheduler.addDownloads(unknown)
+        self._updateSearch(search, checked)
+
+    async def _fetchText(self, cid):
+        """Download a text."""
+        text = await self._call(self._executors["legi"],
+                                lambda: _filterLegiText(
+                                    next(_getText(self._connector, cid))))
+        return ("Text", text)
+
+    def _handleText(self, text):
+        """React to a downloaded text by parsing it."""
+        self._scheduler.textDone()
+        self._parsing += 1
+        self._inFlight.move(text[Types.cid], States.PARSING)
+        self._start(self._parse(text, 
+                                self._inFlight.search(text[Types.cid])[0]))
+
+    async def _parse(self, text, criteria):
+        """Parse a text."""
+        try:
+            parsed = await self._call(self._executors["parse"], _parseText,
+                                      text, criteria)
+        except Exception:
+            #Texts that crash the parser are considered as failed
+            parsed = _mergeArticles(text, [], criteria)
+        return ("Parsed", parsed)
+
+    def _handleParsed(self, parsed):
+        """Buffer a parsed text, and store the buffer when full."""
+        self._parsing -= 1
+        self._parsed.append(parsed)
+        if len(self._parsed) >= self._batchSize:
+            self._flushParsed()
+
+    def _flushParsed(self):
+        """Store the buffered parsed texts."""
+        for text in self._parsed:
+            self._inFlight.move(text[Types.cid], States.STORING)
+        self._start(self._store(self._parsed))
+        self._parsed = []
+
+    async def _store(self, texts):
+        """Store parsed texts in the sink."""
+        await self._call(self._executors["db"], _insertTexts, self._sink,
+                         texts, self._replace)
+        return ("Stored", [x[Types.cid] for x in texts])
+
+    def _handleStored(self, cids):
+        """React to the storage of texts."""
+        self._stored += len(cids)
+        for cid in cids:
+            self._updateSearch(self._inFlight.release(cid))
+            self._scheduler.stored()
+            if self._known is not None:
+                self._known.add(cid)
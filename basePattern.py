@@ -16,7 +16,8 @@ TextPatterns
 
 from enum import Enum
 from dbStructure import Statements
-import re
+from html import unescape
+import hashlib, re
 
 class Bricks(Enum):
     """
@@ -109,6 +110,29 @@ class Bricks(Enum):
                 result.extend(partialResult)
         return result
     
+    def normalise(text):
+        """
+        Simplify the HTML encoding of a text before parsing it.
+        
+        Each sequence of separators (as matched by _newline, non-breaking 
+        spaces included) containing at least one HTML tag is replaced with a
+        single newline character, each other sequence of spaces with a single
+        space, and the other HTML entities are decoded. Patterns meant to parse normalised texts SHOULD use the 
+        _norm* building blocks instead of their raw HTML counterparts.
+
+        Parameters
+        ----------
+        text : str
+            Text as returned by the Legifrance API.
+
+        Returns
+        -------
+        str
+            The normalised text.
+        """
+        return unescape(_separators.sub(
+            lambda x: "\n" if "<" in x[0] else " ", text))
+    
     __baseNewline = r"(?:<p(?: align='\w*')?>|<br/>|</p>| )"
     _newline = __baseNewline + "+"
     _optionalNewline = __baseNewline + "*"
@@ -116,6 +140,14 @@ class Bricks(Enum):
     _romanNumber = r"(?:[IVX]+\. (?:\-|―) )"
     _ANString = r"[\w' \-/]+"
     _XString = r"[\w' \-,/\.]+"
+    #Equivalents of _newline and _optionalNewline in normalised texts
+    _normNewline = r"[\n ]"
+    _normOptionalNewline = r"[\n ]?"
+
+#Separators of normalise: the non-breaking spaces, encoded or not, are
+#collapsed with the others rather than decoded as "\xa0"
+_separators = re.compile(r"(?:<p(?: align='\w*')?>|<br/>|</p>| |\xa0|&nbsp;|"
+                         r"&#160;|&#[xX][aA]0;)+")
 
 class Pattern:
     """
@@ -130,8 +162,11 @@ class Pattern:
     -------
     match(self, text)
         Parse a text and return the captured values.
+    fingerprint(self)
+        Summarise the definition of the pattern chain.
     """
-    def __init__(self, regex, groups, nestedPattern = None, ignored = dict()):
+    def __init__(self, regex, groups, nestedPattern = None, ignored = dict(),
+                 normalised = False):
         """
         Initalise a Pattern object.
 
@@ -156,14 +191,42 @@ class Pattern:
             Each key MUST appear in groups, and be associated with a collection
             of str. All matches where a capturing group captures a value in 
             this collection will be ignored. The default is dict().
+        normalised : bool, optional
+            If True, the pattern expects texts normalised by Bricks.normalise
+            rather than raw HTML. Only the value of the root of a pattern chain
+            is taken into account. The default is False.
         """
-        self.regex = regex.format(*[x.group() for x in groups])
+        #The regex is only built and compiled when first used, so that the
+        #processes that do not parse texts do not pay for it
+        self._template = regex
+        self._regex = None
+        self._compiled = None
         self.groups = groups
         self.ignored = ignored
         self.nestedPattern = nestedPattern
+        self.normalised = normalised
         self.name = "_"
         while self.name in self.groups:
             self.name += "_"
+    
+    @property
+    def regex(self):
+        """Regular expression of the pattern, with its capturing groups."""
+        if self._regex is None:
+            self._regex = self._template.format(*[x.group() 
+                                                  for x in self.groups])
+        return self._regex
+    
+    @regex.setter
+    def regex(self, value):
+        self._regex = value
+        self._compiled = None
+    
+    def _compile(self):
+        """Get the compiled regular expression of the pattern."""
+        if self._compiled is None:
+            self._compiled = re.compile(self.regex)
+        return self._compiled
         
     def _matchPart(self, part):
         """
@@ -191,7 +254,7 @@ class Pattern:
                      p[0])}
                      #only if subpattern exists
                     if self.nestedPattern is not None else {})}
-                for p in re.finditer(self.regex, part)
+                for p in self._compile().finditer(part)
                 #discard any record in ignored
                 if not any([p[key.name] in self.ignored[key]
                         for key in self.ignored])] 
@@ -214,11 +277,33 @@ class Pattern:
             from the parsed text: all the captured groups describing it, except
             those to ignore.
         """
-        match = re.match(self.regex, text)
+        match = self._compile().match(text)
         if match is None:
             return None
         else:
             return Bricks.flatten(self._matchPart(match[0]))
+    
+    def fingerprint(self):
+        """
+        Summarise the definition of the pattern chain.
+        
+        The fingerprint depends on the regex, the capturing groups, the 
+        ignored values and the normalisation of the pattern and of its nested
+        subpatterns: it changes whenever a change in the pattern chain MAY 
+        change the parsing results.
+
+        Returns
+        -------
+        str
+            Hexadecimal digest of the definition of the pattern chain.
+        """
+        definition = (self.regex, [x.name for x in self.groups],
+                      sorted((key.name, sorted(values)) 
+                             for key, values in self.ignored.items()),
+                      self.normalised,
+                      self.nestedPattern.fingerprint() 
+                      if self.nestedPattern is not None else None)
+        return hashlib.sha256(repr(definition).encode()).hexdigest()[:16]
 
 class TextPattern(Enum):
     """
@@ -284,4 +369,35 @@ class TextPattern(Enum):
             from the parsed text: all the captured groups describing it, except
             those to ignore.
         """
-        return cls.main.pattern.match(text)
\ No newline at end of file
+        return cls.main.pattern.match(text)
+    
+    @classmethod
+    def expectsNormalised(cls):
+        """
+        Check if the text must be normalised before being matched.
+
+        Returns
+        -------
+        bool
+            True iff the text SHOULD be normalised by Bricks.normalise before 
+            being passed to the match method.
+        """
+        return cls.main.pattern.normalised
+    
+    @classmethod
+    def fingerprint(cls):
+        """
+        Summarise the definition of the text pattern.
+        
+        Changes to the prepareForInsertion method of the subclass are not 
+        taken into account.
+
+        Returns
+        -------
+        str
+            Hexadecimal digest of the name of the subclass and of the 
+            fingerprint of its main pattern.
+        """
+        return hashlib.sha256((cls.__name__ + 
+                               cls.main.pattern.fingerprint()).encode()
+                              ).hexdigest()[:16]
\ No newline at end of file
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Provide a compact framing of the messages exchanged between processes.
+
+This file does not depend on the content of the messages: the enumerations
+whose members are sent as integer codes are given by the user.
+
+Classes
+-------
+Channel
+    Connection sending messages in batched, optionally compressed frames.
+"""
+from collections import deque
+from enum import Enum
+import io, os, pickle, struct, time, zlib
+
+#Flags and number of messages of a frame
+_HEADER = struct.Struct("<BH")
+_COMPRESSED = 1
+_SHARED = 2
+#Control frame acknowledging a frame placed in shared memory, whose body is
+#the name of the segment
+_RELEASED = 4
+#Size of the body of a frame placed in shared memory, followed by the name of
+#the segment
+_SEGMENT = struct.Struct("<Q")
+
+class Channel:
+    """
+    Connection sending messages in batched, optionally compressed frames.
+
+    Messages MAY be any picklable object. Each frame starts with a fixed
+    header, giving its flags and number of messages, followed by the pickled
+    list of its messages. The members of the enumerations given when creating
+    the channel are pickled as integer codes rather than as a reference to
+    their class and their value, which is especially relevant for enumerations
+    with large values, and the body of large frames is compressed.
+    The body of very large frames, e.g. long texts or batches of parsed texts,
+    MAY instead be placed in a shared memory segment, only its name going
+    through the connection, so that the sender does not wait for the receiver
+    to read it piece by piece from the connection, and the receiver unpickles
+    the messages straight from the segment. The receiver frees the segment 
+    once read and acknowledges it. The sender keeps track of the segments not
+    acknowledged yet, and frees them when it is closed if the receiver is 
+    gone; the receiver frees the segments of the frames it did not read when 
+    it is closed. Thus, a segment is only leaked if both ends stop without 
+    closing their channel.
+    Messages are buffered and sent together, when the buffer is full or before
+    the channel reads from its connection, so that a request and its answer
+    never wait for each other. An agent sending messages and then waiting for
+    another connection MUST call flush before waiting.
+    Both ends of a connection MUST be wrapped in channels created with the
+    same enumerations in the same order.
+
+    Methods
+    -------
+    send(message), flush()
+        Buffer a message, send the buffered messages.
+    recv(), poll(timeout)
+        Receive a message, check if one is available.
+    close()
+        Send the buffered messages, free the shared memory segments and close
+        the connection.
+    """
+    #Seconds during which close waits for the acknowledgement of the shared
+    #memory segments, or for the receiver to leave
+    _CLOSE_TIMEOUT = 5
+    def __init__(self, connection, enums=(), batchSize=64,
+                 compressAbove=None, shareAbove=None):
+        """
+        Wrap a connection.
+
+        Parameters
+        ----------
+        connection : multiprocessing.connection.Connection
+            Connection to wrap, e.g. one of the return values of
+            multiprocessing.Pipe.
+        enums : iterable of Enum subclasses, optional
+            Enumerations whose members are sent as integer codes. The default
+            is ().
+        batchSize : int, optional
+            Maximum number of messages per frame. The default is 64.
+        compressAbove : int, optional
+            Size in bytes above which the body of a frame is compressed. If
+            None, frames are never compressed. The default is None.
+        shareAbove : int, optional
+            Size in bytes above which the body of a frame is placed in shared
+            memory rather than compressed. If None, shared memory is not used.
+            It is not used either before Python 3.8, which lacks 
+            multiprocessing.shared_memory, or on Windows, where a segment is
+            destroyed as soon as its creator closes it. The default is None.
+        """
+        self.connection = connection
+        self._members = [x for enum in enums for x in enum]
+        self._codes = {x: i for i, x in enumerate(self._members)}
+        self._batchSize = batchSize
+        self._compressAbove = compressAbove
+        if shareAbove is not None and os.name == "posix":
+            try:
+                from multiprocessing import shared_memory
+            except ImportError:
+                shareAbove = None
+        else:
+            shareAbove = None
+        self._shareAbove = shareAbove
+        #Names of the segments sent and not acknowledged yet
+        self._shared = set()
+        self._pending = []
+        self._received = deque()
+
+    def send(self, message):
+        """Buffer a message, and send the buffer if it is full."""
+        self._pending.append(message)
+        if len(self._pending) >= self._batchSize:
+            self.flush()
+
+    def flush(self):
+        """Send the buffered messages in a single frame."""
+        if not self._pending:
+            return None
+        buffer = io.BytesIO()
+        buffer.write(bytes(_HEADER.size))
+        _Pickler(buffer, self._codes).dump(self._pending)
+        count, self._pending = len(self._pending), []
+        size = buffer.tell() - _HEADER.size
+        if self._shareAbove is not None and size > self._shareAbove:
+            self._sendShared(buffer.getbuffer()[_HEADER.size:], count)
+            return None
+        if self._compressAbove is not None and \
+                buffer.tell() > self._compressAbove:
+            body = zlib.compress(buffer.getbuffer()[_HEADER.size:], 1)
+            self.connection.send_bytes(_HEADER.pack(_COMPRESSED, count) +
+                                       body)
+            return None
+        with buffer.getbuffer() as frame:
+            _HEADER.pack_into(frame, 0, 0, count)
+            self.connection.send_bytes(frame)
+
+    def _sendShared(self, body, count):
+        """Send a frame whose body is placed in a shared memory segment."""
+        from multiprocessing import shared_memory, resource_tracker
+        segment = shared_memory.SharedMemory(create=True, size=len(body))
+        segment.buf[:len(body)] = body
+        #The segment is tracked by the channel rather than by the resource
+        #tracker of the process, which would also free it if the receiver
+        #unlinks it, see close
+        resource_tracker.unregister("/" + segment.name, "shared_memory")
+        self._shared.add(segment.name)
+        self.connection.send_bytes(_HEADER.pack(_SHARED, count) + 
+                                   _SEGMENT.pack(len(body)) + 
+                                   segment.name.encode())
+        segment.close()
+
+    def _readFrame(self, discard=False):
+        """
+        Read a frame from the connection and buffer its messages, unless 
+        discard is True.
+        """
+        frame = self.connection.recv_bytes()
+        flags, count = _HEADER.unpack_from(frame)
+        body = memoryview(frame)[_HEADER.size:]
+        if flags & _RELEASED:
+            self._shared.discard(bytes(body).decode())
+            return None
+        if flags & _SHARED:
+            name = bytes(body[_SEGMENT.size:]).decode()
+            messages = _readShared(name, _SEGMENT.unpack_from(body)[0],
+                                   None if discard else self._members)
+            try:
+                self.connection.send_bytes(_HEADER.pack(_RELEASED, 0) + 
+                                           name.encode())
+            except OSError:
+                #The sender is gone and will not free the segment anymore
+                pass
+        elif discard:
+            return None
+        else:
+            if flags & _COMPRESSED:
+                body = zlib.decompress(body)
+            messages = _Unpickler(io.BytesIO(body), self._members).load()
+        if not discard:
+            self._received.extend(messages)
+
+    def recv(self):
+        """Receive a message, waiting for it if necessary."""
+        self.flush()
+        while not self._received:
+            self._readFrame()
+        return self._received.popleft()
+
+    def poll(self, timeout=0):
+        """Check if a message is available, waiting at most timeout seconds."""
+        self.flush()
+        #Control frames are read without making a message available
+        while not self._received and self.connection.poll(timeout):
+            self._readFrame()
+            timeout = 0
+        return bool(self._received)
+
+    def close(self):
+        """
+        Send the buffered messages, free the shared memory segments and close
+        the connection.
+
+        The segments sent and not acknowledged are freed if the receiver 
+        closes its end within a few seconds; otherwise, the receiver MAY still
+        read them and they are left for it to free. The segments of the frames
+        not read are freed.
+
+        Returns
+        -------
+        None.
+        """
+        try:
+            self.flush()
+            deadline = time.time() + self._CLOSE_TIMEOUT
+            while True:
+                #Frames left are read only to free their segments
+                while self.connection.poll(0):
+                    self._readFrame(discard=True)
+                if not self._shared or time.time() > deadline:
+                    break
+                self.connection.poll(min(0.1, self._CLOSE_TIMEOUT))
+        except (EOFError, OSError):
+            #The other end is closed: nobody will read the segments left
+            for name in self._shared:
+                _unlink(name)
+        self._shared = set()
+        self.connection.close()
+
+def _readShared(name, size, members):
+    """
+    Unpickle the messages of a frame from its shared memory segment, unless 
+    members is None, and free the segment.
+    """
+    from multiprocessing import shared_memory
+    segment = shared_memory.SharedMemory(name)
+    try:
+        if members is None:
+            return None
+        with segment.buf[:size] as body:
+            return _Unpickler(_Reader(body), members).load()
+    finally:
+        segment.close()
+        segment.unlink()
+
+def _unlink(name):
+    """Free a shared memory segment, if it still exists."""
+    from multiprocessing import shared_memory
+    try:
+        segment = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return None
+    segment.close()
+    segment.unlink()
+
+class _Reader:
+    """
+    Minimal binary file reading a buffer without copying it first, unlike
+    io.BytesIO, so that each piece is only copied when unpickled.
+    """
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        if size < 0:
+            self._position = len(self._buffer)
+        else:
+            self._position = min(start + size, len(self._buffer))
+        return self._buffer[start:self._position].tobytes()
+
+    def readline(self):
+        #Only used by the text opcodes of pickle, never by the Pickler below
+        start = self._position
+        while self._position < len(self._buffer):
+            self._position += 1
+            if self._buffer[self._position - 1] == 10:
+                break
+        return self._buffer[start:self._position].tobytes()
+
+class _Pickler(pickle.Pickler):
+    """Pickler replacing the members of known enumerations by their code."""
+    def __init__(self, file, codes):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self._codes = codes
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Enum):
+            return self._codes.get(obj)
+        return None
+
+class _Unpickler(pickle.Unpickler):
+    """Unpickler converting the codes back to members of enumerations."""
+    def __init__(self, file, members):
+        super().__init__(file)
+        self._members = members
+
+    def persistent_load(self, code):
+        return self._members[code]
@@ -17,11 +17,17 @@ createDbManager
     Create a listener ready to query the database.
 """
 from enum import Enum
-from multiprocessing import connection
-from legiConnector import LegiConnector
-from dbConnector import DbConnector
-from dbStructure import Types, Statements, prepareStatements
+from multiprocessing import connection, Pipe, Pool
+from zlib import crc32
+import hashlib, json
+from dbStructure import Types
+from basePattern import Bricks
 from legiStructure import SearchFilters
+from knownCids import KnownCids
+from inFlight import InFlightTracker, States
+from scheduler import Scheduler
+from sinks import Sink, PostgresSink
+from channel import Channel
 
 class Markers(Enum):
     """
@@ -33,17 +39,35 @@ class Markers(Enum):
     END = "__END__"
     TEXT_LIST = "__TEXT_LIST__"
     TEXT = "__TEXT__"
+    KNOWN = "__KNOWN__"
+    FAILED = "__FAILED__"
+
+#Size in bytes above which the frames between processes are compressed, or
+#handed over in shared memory
+_COMPRESS_ABOVE = 1 << 16
+_SHARE_ABOVE = 1 << 20
+
+def _channel(pipeEnd):
+    """Wrap a connection to another agent in a Channel, see channel.py."""
+    if isinstance(pipeEnd, Channel):
+        return pipeEnd
+    return Channel(pipeEnd, (Markers, SearchFilters, Types), 
+                   compressAbove=_COMPRESS_ABOVE, shareAbove=_SHARE_ABOVE)
 
 def _parseText(text, criteria = SearchFilters.TAFilter):
     """
     Parse the content of a text to extract the data of interest.
+    
+    Each article of the text is parsed independently (see _parseArticle) and
+    the results are merged (see _mergeArticles).
 
     Parameters
     ----------
     text : dict
         MUST contain a key "content" containing the text as returned by
-        the Legifrance API. This is consistent with the return value of 
-        the getText method.
+        the Legifrance API, or a key "articles" containing the list of its
+        articles. This is consistent with the return value of 
+        the _filterLegiText method.
     criteria : SearchFilters, optional
         Filter through which the text was retrieved. This is used to 
         determine which pattern to match the text against.
@@ -54,7 +78,8 @@ def _parseText(text, criteria = SearchFilters.TAFilter):
     dict
         Contains at least two keys: "success", which is True iff the text was 
         successfully parsed and False otherwise, and Types.cid, 
-        associated with the CID of the text. If "success" is True, 
+        associated with the CID of the text, as well as the version of the 
+        parsing (see _mergeArticles). If "success" is True, 
         it also contains Types.publicationDate (associated with a Unix 
         timestamp of the publication date of the text) and "data"
         (associated with a list of the parsed data from the text in the format
@@ -62,22 +87,131 @@ def _parseText(text, criteria = SearchFilters.TAFilter):
         The value associated with "data" MAY be an empty string if every record
         has been ignored.
     """
+    return _mergeArticles(text, [_parseArticle(text[Types.cid], x, criteria)
+                                 for x in _articles(text)], criteria)
+
+def _articles(text):
+    """
+    List the contents of the articles of a text.
+
+    Parameters
+    ----------
+    text : dict
+        Text as returned by _filterLegiText.
+
+    Returns
+    -------
+    list
+        Content of each article of the text, in a HTML encoding.
+    """
+    return text["articles"] if "articles" in text else [text["content"]]
+
+def _parseArticle(cid, content, criteria = SearchFilters.TAFilter):
+    """
+    Parse the content of an article to extract the data of interest.
+    
+    The article is matched against the structures of the filter, in order, 
+    until one of them matches.
+
+    Parameters
+    ----------
+    cid : str
+        CID of the text containing the article.
+    content : str
+        Content of the article, as returned by the Legifrance API.
+    criteria : SearchFilters, optional
+        Filter through which the text was retrieved. 
+        The default is SearchFilters.TAFilter.
+
+    Returns
+    -------
+    list or None
+        None if the article could not be parsed, otherwise the list of the 
+        parsed data from the article in the format expected by the 
+        insertRecord query.
+    """
+    if content is None:
+        return None
     patterns = criteria.structs
+    #Normalise at most once, and only if a pattern expects it
+    normalised = None
     tmpResult = None
     index = -1
     while tmpResult is None and index < len(patterns)-1:
         index += 1
-        tmpResult = patterns[index].match(text["content"])
+        if patterns[index].expectsNormalised():
+            if normalised is None:
+                normalised = Bricks.normalise(content)
+            tmpResult = patterns[index].match(normalised)
+        else:
+            tmpResult = patterns[index].match(content)
     if tmpResult is None:
-        return {Types.cid:text[Types.cid], "success":False}
+        return None
+    return list(patterns[index].prepareForInsertion(tmpResult, cid))
+
+def _mergeArticles(text, parsedArticles, criteria):
+    """
+    Merge the parsing results of the articles of a text.
+    
+    The text is successfully parsed iff it has at least one article and all
+    its articles were successfully parsed.
+
+    Parameters
+    ----------
+    text : dict
+        MUST contain the keys Types.cid and Types.publicationDate, and MAY 
+        contain the key "contentHash", as returned by _filterLegiText.
+    parsedArticles : list
+        Results of _parseArticle for each article of the text, in order.
+    criteria : SearchFilters
+        Filter whose structures were used to parse the articles.
+
+    Returns
+    -------
+    dict
+        Parsed text, as described in _parseText. Whether the parsing 
+        succeeded or not, it contains the version of the parsing: the name of
+        the filter ("filter"), the fingerprint of its structures 
+        ("fingerprint", see _filterFingerprint) and the hash of the content
+        of the text ("contentHash", None if unknown).
+    """
+    version = {"filter": criteria.name, 
+               "fingerprint": _filterFingerprint(criteria),
+               "contentHash": text.get("contentHash")}
+    if not parsedArticles or any(x is None for x in parsedArticles):
+        return {Types.cid:text[Types.cid], "success":False, **version}
     else:
         return {Types.cid:text[Types.cid], 
                 Types.publicationDate: text[Types.publicationDate]//1000,
-                "data":list(patterns[index].prepareForInsertion(tmpResult, 
-                                                           text[Types.cid])), 
-                "success":True}
+                "data":[y for x in parsedArticles for y in x], 
+                "success":True, **version}
+
+#Fingerprint of the structures of each filter, computed once per process
+_fingerprints = dict()
+
+def _filterFingerprint(criteria):
+    """
+    Summarise the structures used to parse the texts of a filter.
+
+    Parameters
+    ----------
+    criteria : SearchFilters
+        The filter.
 
-def createTextProvider(args, pipeEnd):
+    Returns
+    -------
+    str
+        Hexadecimal digest of the fingerprints of the structures of the
+        filter, in order. It changes whenever one of them changes.
+    """
+    if criteria not in _fingerprints:
+        _fingerprints[criteria] = hashlib.sha256(" ".join(
+            x.fingerprint() for x in criteria.structs).encode()
+            ).hexdigest()[:16]
+    return _fingerprints[criteria]
+
+def createTextProvider(args, pipeEnd, pageSize=None, trace=False, 
+                       cassette=None):
     """
     Create a listener ready to transfer texts from Legifrance to a pipe.
     
@@ -88,72 +222,156 @@ def createTextProvider(args, pipeEnd):
     process can end or a tuple (value from Markers, args corresponding to
     the marker).
     
-    Markers.TEXT_LIST: associated with a SearchFilters object, get a list
-    of CIDs from Legifrance, followed by a last message (Markers.END, filter).
+    Markers.TEXT_LIST: associated with a SearchFilters object, a page 
+    number and a window of publication dates (or None), get a page of CIDs 
+    from Legifrance, sent as a message (Markers.TEXT_LIST, filter, list of 
+    CIDs, True iff it is the last page, window, total number of results).
     
     Markers.TEXT: associated with a CID or a list of CIDs, get a (list of) 
     text(s) from Legifrance.
+    
+    Each order is completed before the next one is read, so that the agent
+    sending the orders decides how the requests are interleaved.
+    If an order fails, e.g. because the query is missing from the cassette 
+    being replayed, a message (Markers.FAILED, description of the error) is
+    sent and the other orders are ignored until Markers.END is received,
+    after which the error is raised.
+    The messages are exchanged through a Channel, the other end of the 
+    connection MUST be wrapped in a Channel with the same enumerations.
 
     Parameters
     ----------
     args : tuple
-        Arguments to create a LegiConnector object.
+        Arguments to create a LegiConnector object. If its first element is
+        itself a tuple or a list, args is a collection of (client_id, 
+        client_secret) pairs used to create a LegiConnectorPool object 
+        instead.
     pipeEnd : multiprocessing.connection.Connection
         This connection MUST be read/write. The easiest way to get
         such an object is to use one of the return values of 
         multiprocessing.Pipe(True).
+    pageSize : int, optional
+        Number of CIDs to request per page of search results. If None, the
+        page size defined in the payload of each filter is used. The default 
+        is None.
+    trace : bool or str, optional
+        If True, statistics on the queries sent to Legifrance are printed when
+        the listener ends. If it is a str, each query is also written in the 
+        file at this path. The default is False.
+    cassette : Cassette, optional
+        Cassette recording the queries to Legifrance or replaying them 
+        instead of querying Legifrance. The default is None.
     """
-    connector = LegiConnector(*args)
-    order = pipeEnd.recv()
-    while order != Markers.END:
-        if(order[0] == Markers.TEXT_LIST):
-            for textList in _getTextIdList(connector, order[1]):
-                pipeEnd.send((Markers.TEXT_LIST, order[1], textList))
-            pipeEnd.send((Markers.END, order[1]))
-        elif order[0] == Markers.TEXT:
-            for text in _getText(connector, order[1]):
-                pipeEnd.send((Markers.TEXT, _filterLegiText(text)))
+    connector, tracer = _createConnector(args, trace, cassette)
+    pipeEnd = _channel(pipeEnd)
+    try:
         order = pipeEnd.recv()
+        failed = None
+        while order != Markers.END:
+            try:
+                if failed is not None:
+                    pass
+                elif(order[0] == Markers.TEXT_LIST):
+                    textList, isLast, total = _getTextIdPage(
+                        connector, order[1], order[2], pageSize, order[3])
+                    pipeEnd.send((Markers.TEXT_LIST, order[1], textList, 
+                                  isLast, order[3], total))
+                elif order[0] == Markers.TEXT:
+                    for text in _getText(connector, order[1]):
+                        pipeEnd.send((Markers.TEXT, _filterLegiText(text)))
+            except Exception as e:
+                #The Middleman cannot complete its orders anymore
+                failed = e
+                print("Legifrance agent failed: " + repr(e))
+                pipeEnd.send((Markers.FAILED, repr(e)))
+            order = pipeEnd.recv()
+    finally:
+        #Frees the shared memory segments left, see Channel
+        pipeEnd.close()
+    if tracer is not None:
+        tracer.close()
+        print(tracer.summary())
+    if cassette is not None:
+        cassette.close()
+    if failed is not None:
+        #The process exits with an error once the other agents are stopped
+        raise failed
+
+def _createConnector(args, trace=False, cassette=None):
+    """
+    Create the connection to Legifrance.
+
+    Parameters
+    ----------
+    args : tuple
+        Arguments as described in createTextProvider.
+    trace : bool or str, optional
+        Tracing option as described in createTextProvider. 
+        The default is False.
+    cassette : Cassette, optional
+        Cassette as described in createTextProvider. The default is None.
+
+    Returns
+    -------
+    connector : LegiConnector or LegiConnectorPool
+        Connection to Legifrance.
+    tracer : HttpTracer or None
+        Recorder of the queries sent through the connection, if trace is set.
+    """
+    #requests is only imported by the processes querying Legifrance
+    from legiConnector import LegiConnector, LegiConnectorPool, HttpTracer
+    tracer = None
+    if trace:
+        tracer = HttpTracer(trace if isinstance(trace, str) else None)
+    if isinstance(args[0], (tuple, list)):
+        return LegiConnectorPool(args, tracer=tracer, 
+                                 cassette=cassette), tracer
+    return LegiConnector(*args, tracer=tracer, cassette=cassette), tracer
     
-def _getTextIdList(legiConnector, criteria = SearchFilters.TAFilter):
+def _getTextIdPage(legiConnector, criteria, pageNumber, pageSize = None,
+                   window = None):
     """
-    Get a list of text IDs from Legifrance and yield them by blocks.
+    Get a page of text IDs from Legifrance.
     
     Use the Legifrance API to get a list of text CIDs corresponding to the 
     input search criteria. Assume that the input is well-formed and do not
-    handle errors otherwise. The results are yielded by blocks as a list where 
-    each element is the CID of a text matching the input criteria.
+    handle errors otherwise.
 
     Parameters
     ----------
     legiConnector : LegiConnector
         Connection to Legifrance.
-    pipeEnd : multiprocessing.connection.Connection
-        This connection MUST be writable, it MAY be write-only (i.e. 
-        its only method of interest is send(obj)). The easiest way to get
-        such an object is to use the second return value of 
-        multiprocessing.Pipe(bool), where the boolean MAY be False.
-    criteria : SearchFilters, optional
+    criteria : SearchFilters
         Filter determining which type of texts to retrieve. 
-        The default is SearchFilters.TAFilter.
+    pageNumber : int
+        Page to get from Legifrance, starting at 1.
+    pageSize : int, optional
+        Number of CIDs per page. If None, the page size of the payload of the
+        filter is used. The default is None.
+    window : tuple, optional
+        If provided, only the texts published between the two dates of the
+        tuple, included, as "YYYY-MM-DD" str, are retrieved. 
+        The default is None.
     
-    Yields
-    ------
-    List
+    Returns
+    -------
+    textList : list
         List of CIDs of texts matching the search filter.
+    isLast : bool
+        True iff there is no more page of results for this filter.
+    totalResultNumber : int
+        Total number of results for this filter.
     """
-    pageNumber, currentResultNumber = 1, 0
-    pageNumber, currentResultNumber, totalResultNumber, textList = \
+    if pageSize is None:
+        pageSize = criteria.payload["recherche"]["pageSize"]
+    _, resultNumber, totalResultNumber, textList = \
         _getTextIdListHelper(pageNumber, criteria, legiConnector,
-                             currentResultNumber)
-    yield textList
-    while currentResultNumber < totalResultNumber:  
-        pageNumber, currentResultNumber, totalResultNumber, textList = \
-            _getTextIdListHelper(pageNumber, criteria, legiConnector, 
-                                 currentResultNumber)
-        yield textList
+                             (pageNumber - 1) * pageSize, pageSize, window)
+    return textList, not textList or resultNumber >= totalResultNumber, \
+        totalResultNumber
 
-def _getTextIdListHelper(pageNumber, criteria, legiConnector, resultNumber):
+def _getTextIdListHelper(pageNumber, criteria, legiConnector, resultNumber,
+                         pageSize = None, window = None):
     """
     Get a page of results from Legifrance.
 
@@ -167,6 +385,13 @@ def _getTextIdListHelper(pageNumber, criteria, legiConnector, resultNumber):
         Connection to Legifrance.
     resultNumber : int
         Current number of results returned so far or this filter.
+    pageSize : int, optional
+        Number of CIDs per page. If None, the page size of the payload of the
+        filter is used. The default is None.
+    window : tuple, optional
+        If provided, only the texts published between the two dates of the
+        tuple, included, as "YYYY-MM-DD" str, are retrieved. 
+        The default is None.
 
     Returns
     -------
@@ -180,16 +405,29 @@ def _getTextIdListHelper(pageNumber, criteria, legiConnector, resultNumber):
     textList : list
         List of CIDs of texts from the page of results.
     """
-    currentCriteria = criteria.payload
-    currentCriteria["recherche"]["pageNumber"] = pageNumber
+    currentCriteria = dict(criteria.payload)
+    currentCriteria["recherche"] = dict(currentCriteria["recherche"], 
+                                        pageNumber=pageNumber)
+    if pageSize is not None:
+        currentCriteria["recherche"]["pageSize"] = pageSize
+    if window is not None:
+        currentCriteria["recherche"]["filtres"] = \
+            currentCriteria["recherche"].get("filtres", []) + \
+            [{"facette": _DATE_FACET, 
+              "dates": {"start": window[0], "end": window[1]}}]
     results = legiConnector.post("/search", currentCriteria)
     totalResultNumber = results["totalResultNumber"]
     resultNumber += len(results["results"])
-    currentCriteria["recherche"].pop("pageNumber")
     pageNumber += 1
     return pageNumber, resultNumber, totalResultNumber, \
         [x["titles"][0]["cid"] for x in results["results"]]
 
+#Facet of the /search queries filtering on the publication date
+_DATE_FACET = "DATE_PUBLICATION"
+
+#Fields of the /consult/jorf responses used by _filterLegiText
+_TEXT_FIELDS = ("cid", "dateParution", "articles.item.content")
+
 def _getText(legiConnector, cid):
     """
     Retrieve one or more text based on its/their CID(s).
@@ -204,14 +442,16 @@ def _getText(legiConnector, cid):
     Yields
     ------
     dict
-        The text corresponding to the Legifrance response.
+        The text corresponding to the Legifrance response, reduced to the 
+        fields needed by _filterLegiText.
     """
     if isinstance(cid, list):
         retrieve = cid
     else:
         retrieve = [cid]
     for e in retrieve:
-        result = legiConnector.post("/consult/jorf", {"textCid":e})
+        result = legiConnector.post("/consult/jorf", {"textCid":e}, 
+                                    _TEXT_FIELDS)
         yield result
         
 def _filterLegiText(text):
@@ -227,16 +467,24 @@ def _filterLegiText(text):
     -------
     dict
         The CID (Types.cid), publication date (Types.publicationDate), 
-        as a timestamp in milliseconds, and content ("content") of the text
-        in a HTML encoding.
+        as a timestamp in milliseconds, a hash of the contents of its articles
+        ("contentHash"), and either the content ("content") of
+        the text in a HTML encoding if it has exactly one article, or the list
+        of the contents of its articles ("articles") otherwise.
     """
-    return {Types.cid: text["cid"],
-            Types.publicationDate: text["dateParution"],
-            #"articles" is a list that seems to always have only 1 element?!
-            "content": (text["articles"][0]["content"] 
-                        if len(text["articles"]) == 1 else None)}
+    #The content of an article MAY be missing: only its text fails to parse
+    articles = [x.get("content") for x in text["articles"]]
+    result = {Types.cid: text["cid"],
+              Types.publicationDate: text["dateParution"],
+              "contentHash": hashlib.sha256("\0".join(
+                  x or "" for x in articles).encode()).hexdigest()[:16]}
+    if len(articles) == 1:
+        result["content"] = articles[0]
+    else:
+        result["articles"] = articles
+    return result
 
-def createDbManager(args, pipeEnd):
+def createDbManager(args, pipeEnd, sendKnown=True):
     """
     Create a listener ready to query the database.
     
@@ -246,50 +494,95 @@ def createDbManager(args, pipeEnd):
     process can end or a tuple (value from Markers, args corresponding to
     the marker).
     
-    Markers.TEXT_LIST: associated with a list of CIDs, check if they are 
-    already stored in the database.
+    Markers.TEXT_LIST: associated with a request ID and a list of CIDs, check
+    if they are already stored in the database.
     
     Markers.TEXT: associated with a list of parsed texts, store them in the
     database.
+    
+    When the database is ready, and if it can list the CIDs it already 
+    contains (see Sink.knownCids), the listener first sends a message 
+    (Markers.KNOWN, list of the known CIDs) so that the other agents can filter
+    the CIDs to query locally.
+    
+    Several listeners MAY share the database, each with its own connection.
+    Only one of them SHOULD then send the known CIDs.
+    The messages are exchanged through a Channel, the other end of the 
+    connection MUST be wrapped in a Channel with the same enumerations.
 
     Parameters
     ----------
-    args : tuple
-        Arguments to create a LegiConnector object.
+    args : tuple or Sink
+        Arguments to create a DbConnector object, in which case the results
+        are stored in the PostgreSQL database, or Sink object in which the
+        results will be stored.
     pipeEnd : multiprocessing.connection.Connection
         This connection MUST be read/write. The easiest way to get
         such an object is to use the second return value of 
         multiprocessing.Pipe(True).
+    sendKnown : bool, optional
+        If False, the known CIDs are not sent. The default is True.
     """
-    order = pipeEnd.recv()
-    with DbConnector(*args) as connector:
-        prepareStatements(connector)
-        while order != Markers.END:
-            if order[0] == Markers.TEXT_LIST:
-                _checkIfKnown(connector, pipeEnd, order[1])
-            elif order[0] == Markers.TEXT:
-                _storeText(connector, pipeEnd, order[1])
-            order = pipeEnd.recv()
+    sink = args if isinstance(args, Sink) else PostgresSink(*args)
+    pipeEnd = _channel(pipeEnd)
+    try:
+        order = pipeEnd.recv()
+        with sink:
+            if sendKnown:
+                _sendKnownCids(sink, pipeEnd)
+            while order != Markers.END:
+                if order[0] == Markers.TEXT_LIST:
+                    _checkIfKnown(sink, pipeEnd, order[1], order[2])
+                elif order[0] == Markers.TEXT:
+                    _storeText(sink, pipeEnd, order[1])
+                order = pipeEnd.recv()
+    finally:
+        #Frees the shared memory segments left, see Channel
+        pipeEnd.close()
 
-def _checkIfKnown(dbConnector, pipeEnd, cidList):
+def _sendKnownCids(sink, pipeEnd):
+    """
+    Send the list of the CIDs already stored in the database through the pipe.
+    
+    The message is a tuple (Markers.KNOWN, list of CIDs). Nothing is sent if
+    the sink cannot list the CIDs it contains.
+
+    Parameters
+    ----------
+    sink : Sink
+        Destination of the parsing results, already opened.
+    pipeEnd : multiprocessing.connection.Connection
+        This connection MUST be writable, it MAY be write-only.
+
+    Returns
+    -------
+    None.
+    """
+    cids = sink.knownCids()
+    if cids is not None:
+        pipeEnd.send((Markers.KNOWN, cids))
+
+def _checkIfKnown(sink, pipeEnd, requestId, cidList):
     """
     Check if one or more texts are already stored in the database.
     
     Query the database to check if it already contains the input CID(s).
     The results are pushed through the pipe whose end is given as input: 
     a single message, a tuple containing three elements: Markers.TEXT_LIST,
-    the first cid in the query, and a list containing as elements the CIDs 
+    the ID of the request, and a list containing as elements the CIDs 
     that were not found in the database.
 
     Parameters
     ----------
-    dbConnector : DbConnector
-        Connection to the database.
+    sink : Sink
+        Destination of the parsing results, already opened.
     pipeEnd : multiprocessing.connection.Connection
         This connection MUST be writable, it MAY be write-only (i.e. 
         its only method of interest is send(obj)). The easiest way to get
         such an object is to use the second return value of 
         multiprocessing.Pipe(bool), where the boolean MAY be False.
+    requestId : int
+        ID of the request, sent back with the results.
     cidList : str or list of str
             CID of the text to check, or list of CIDs of texts to check.
 
@@ -299,27 +592,23 @@ def _checkIfKnown(dbConnector, pipeEnd, cidList):
     """
     if isinstance(cidList, str):
         cidList = [cidList]
-    refCid = cidList[0]
     for i in range(len(cidList)):
-        cid = cidList[i]
-        result = dbConnector.executeAndFetch(Statements.selectCid.query, (cid,))
-        if result[0][0]:
+        if sink.isKnown(cidList[i]):
             cidList[i] = None
-    pipeEnd.send((Markers.TEXT_LIST, refCid, 
+    pipeEnd.send((Markers.TEXT_LIST, requestId, 
                   [x for x in cidList if x is not None]))
 
-def _storeText(dbConnector, pipeEnd, texts):
+def _storeText(sink, pipeEnd, texts):
     """
     Store the input parsed text(s) in the database.
     
-    For each text stored in the database, a message (Markers.TEXT, cid) will
-    be sent through pipeEnd. When all the texts have been stored, a message
-    (Markers.END) will be sent as well.
+    When all the texts have been stored, a single message (Markers.TEXT, 
+    list of the CIDs of the stored texts) is sent through pipeEnd.
 
     Parameters
     ----------
-    dbConnector : DbConnector
-        Connection to the database.
+    sink : Sink
+        Destination of the parsing results, already opened.
     pipeEnd : multiprocessing.connection.Connection
         This connection MUST be writable, it MAY be write-only (i.e. 
         its only method of interest is send(obj)). The easiest way to get
@@ -338,25 +627,99 @@ def _storeText(dbConnector, pipeEnd, texts):
     """
     if isinstance(texts, dict):
         texts = [texts]
+    _insertTexts(sink, texts)
+    pipeEnd.send((Markers.TEXT, [x[Types.cid] for x in texts]))
+
+def _insertTexts(sink, texts, replace=False):
+    """
+    Store parsed texts in the sink and commit them.
+
+    Parameters
+    ----------
+    sink : Sink
+        Destination of the parsing results, already opened.
+    texts : list of dict
+        Parsed texts as described in _storeText.
+    replace : bool, optional
+        If True, the results previously stored for the texts are deleted 
+        first. The default is False.
+
+    Returns
+    -------
+    None.
+    """
+    if replace:
+        sink.deleteTexts([x[Types.cid] for x in texts])
     success = []
     failure = []
     for text in texts:
-            if text["success"]:
-                success.append(text)
-            else:
-                failure.append(text[Types.cid])
+        if text["success"]:
+            success.append(text)
+        else:
+            failure.append(text[Types.cid])
     if failure:
-        dbConnector.executeMany(Statements.insertFailed.query, 
-                                [(x,) for x in failure])
+        sink.insertFailed(failure)
     if success:
-        dbConnector.executeMany(Statements.insertParsed.query,
-            [(x[Types.cid], x[Types.publicationDate]) for x in success])
-        dbConnector.executeMany(Statements.insertRecord.query,
-                                [y for x in success for y in x["data"] ])
-    dbConnector.commit()
-    for text in texts:
-        pipeEnd.send((Markers.TEXT, text[Types.cid]))
-    pipeEnd.send(Markers.END)
+        sink.insertParsed(success)
+    sink.insertVersions([x for x in texts if "fingerprint" in x])
+    sink.commit()
+
+def _readCompletedWindows(windowState):
+    """
+    Read the windows of publication dates already completed.
+
+    Parameters
+    ----------
+    windowState : str or None
+        Path to the file listing the completed windows, one JSON object with
+        keys "filter", "start" and "end" per line.
+
+    Returns
+    -------
+    list of dict
+        The completed windows, empty if the file does not exist or windowState
+        is None.
+    """
+    if windowState is None:
+        return []
+    try:
+        with open(windowState) as file:
+            return [json.loads(x) for x in file if x.strip()]
+    except FileNotFoundError:
+        return []
+
+def _isCompleted(completed, criteria, window):
+    """Check if a window of a search is within a completed window."""
+    return window is not None and any(
+        x["filter"] == criteria.name and x["start"] <= window[0]
+        and window[1] <= x["end"] for x in completed)
+
+def _recordCompletedWindow(windowState, completed, search):
+    """
+    Record that the window of a search is completed.
+
+    Parameters
+    ----------
+    windowState : str or None
+        Path to the file listing the completed windows. If None, the window
+        is not recorded.
+    completed : list of dict
+        Completed windows, as returned by _readCompletedWindows. The window is
+        appended to it.
+    search : tuple
+        (filter, window) tuple of the completed search.
+
+    Returns
+    -------
+    None.
+    """
+    if search[1] is None or windowState is None:
+        return None
+    window = {"filter": search[0].name, "start": search[1][0],
+              "end": search[1][1]}
+    completed.append(window)
+    with open(windowState, "a") as file:
+        file.write(json.dumps(window) + "\n")
         
 class Middleman:
     """
@@ -366,7 +729,8 @@ class Middleman:
     create method should be used instead: when the object is fully initialised,
     it has already become useless.
     """
-    def create(toLegi, toDb, fromCommand):
+    def create(toLegi, toDb, fromCommand, parseWorkers=0, batchSize=1,
+               maxInFlight=None, windowPages=5, windowState=None):
         """
         Blocking method creating a one-time Middleman.
         
@@ -387,26 +751,53 @@ class Middleman:
             API.
             The easiest way to get such an object is to use one of the return 
             values of multiprocessing.Pipe(True).
-        toDb : multiprocessing.connection.Connection
+        toDb : multiprocessing.connection.Connection or list
             This connection MUST be read/write. It will be used to send orders 
             to and receive results from the agent in charge of the interactions
             with the database.
             The easiest way to get such an object is to use one of the return 
             values of multiprocessing.Pipe(True).
+            It MAY also be a list of such connections, each to its own agent:
+            the existence checks are then sent to the least busy agent and 
+            each text is stored by the agent selected by the hash of its CID.
+            Only the first agent SHOULD send the known CIDs.
         fromCommand : multiprocessing.connection.Connection
             This connection MUST be read/write. It will be used to receive
             orders from and send completion reports to the main agent.
             The easiest way to get such an object is to use one of the return 
             values of multiprocessing.Pipe(True).
+        parseWorkers : int, optional
+            Number of worker processes parsing the texts. Each article of a
+            text is parsed separately. If 0, the texts are parsed by the 
+            Middleman itself. The default is 0.
+        batchSize : int, optional
+            Number of parsed texts sent at once to the database. Smaller 
+            batches are sent when no other text is being downloaded or 
+            parsed. The default is 1.
+        maxInFlight : int, optional
+            Maximum number of texts requested from Legifrance and not yet
+            stored in the database. If None, there is no limit. 
+            The default is None.
+        windowPages : int, optional
+            Maximum number of pages of search results per window of 
+            publication dates, above which the window is split. 
+            The default is 5.
+        windowState : str, optional
+            Path to a file listing the windows of publication dates already
+            completed, which are skipped, and where newly completed windows 
+            are appended. If None, all the windows are searched.
+            The default is None.
 
         Returns
         -------
         None.
 
         """
-        Middleman(toLegi, toDb, fromCommand)
+        Middleman(toLegi, toDb, fromCommand, parseWorkers, batchSize, 
+                  maxInFlight, windowPages, windowState)
         
-    def __init__(self, toLegi, toDb, fromCommand):
+    def __init__(self, toLegi, toDb, fromCommand, parseWorkers=0, batchSize=1,
+                 maxInFlight=None, windowPages=5, windowState=None):
         """
         Create an object transfering messages between Legifrance and the DB.
         
@@ -414,6 +805,12 @@ class Middleman:
         get orders from the main agent and convert and transfer messages 
         between the agents respectively in charge of the interactions with 
         Legifrance and the database.
+        An order is either a SearchFilters object, to retrieve all its texts,
+        a tuple (SearchFilters object, (start, end)) to retrieve the texts 
+        published between the dates start and end, included, as "YYYY-MM-DD"
+        str, or Markers.END to signal that no more order will be sent.
+        The connections to the Legifrance and DB agents are wrapped in 
+        Channels, as done by createTextProvider and createDbManager.
         When the initialisation process returns, the object has already 
         finished its job and has become useless.
 
@@ -425,10 +822,10 @@ class Middleman:
             API.
             The easiest way to get such an object is to use one of the return 
             values of multiprocessing.Pipe(True).
-        toDb : multiprocessing.connection.Connection
+        toDb : multiprocessing.connection.Connection or list
             This connection MUST be read/write. It will be used to send orders 
             to and receive results from the agent in charge of the interactions
-            with the database.
+            with the database, or list of such connections to several agents.
             The easiest way to get such an object is to use one of the return 
             values of multiprocessing.Pipe(True).
         fromCommand : multiprocessing.connection.Connection
@@ -436,21 +833,90 @@ class Middleman:
             orders from and send completion reports to the main agent.
             The easiest way to get such an object is to use one of the return 
             values of multiprocessing.Pipe(True).
+        parseWorkers : int, optional
+            Number of worker processes parsing the texts. Each article of a
+            text is parsed separately. If 0, the texts are parsed by the 
+            Middleman itself. The default is 0.
+        batchSize : int, optional
+            Number of parsed texts sent at once to the database. 
+            The default is 1.
+        maxInFlight : int, optional
+            Maximum number of texts requested from Legifrance and not yet
+            stored in the database. If None, there is no limit. 
+            The default is None.
+        windowPages : int, optional
+            Maximum number of pages of search results per window of 
+            publication dates. The default is 5.
+        windowState : str, optional
+            Path to a file listing the completed windows of publication dates.
+            The default is None.
         """
+        #Searches, i.e. (filter, window) tuples, are kept here until all 
+        #their texts are stored
         self._commandsSet = {"wait"}
-        self._commandsDict = dict()
-        self._toLegi = toLegi
-        self._toDb = toDb
+        #Search and state of the CIDs being checked or processed
+        self._inFlight = InFlightTracker()
+        #Filled when the DB agent sends the CIDs it already knows
+        self._known = None
+        toDb = list(toDb) if isinstance(toDb, (list, tuple)) else [toDb]
+        waitList = [toLegi, fromCommand] + toDb
+        self._toLegi = _channel(toLegi)
+        self._toDb = [_channel(x) for x in toDb]
+        #Number of existence checks sent to each DB agent and not answered
+        self._dbChecks = [0] * len(self._toDb)
         self._fromCommand = fromCommand
+        self._batchSize = batchSize
+        #Decides what to request from Legifrance
+        self._scheduler = Scheduler(lookahead=max(20, batchSize), 
+                                    maxInFlight=maxInFlight,
+                                    windowPages=windowPages)
+        #Searches with no more page to fetch
+        self._paginated = set()
+        self._windowState = windowState
+        self._completed = _readCompletedWindows(windowState)
+        #Texts being parsed, and the parsing state of each of their articles
+        self._parsing = 0
+        self._articles = dict()
+        #Parsed texts waiting to be sent to each DB agent
+        self._parsed = [[] for _ in self._toDb]
+        self._pool = None
+        #True once the Legifrance agent cannot complete orders anymore
+        self._failed = False
+        if parseWorkers:
+            self._pool = Pool(parseWorkers)
+            #The workers' results are sent back through this pipe
+            self._fromPool, self._toSelf = Pipe(False)
+            waitList.append(self._fromPool)
         while self._continue():
-            connection.wait([toLegi, toDb, fromCommand])
+            connection.wait(waitList)
             #Each method checks if its connection is ready
             self._handleOrder()
             self._handleLegiMsg()
+            self._handleParsed()
             self._handleDbMsg()
+            if any(self._parsed) and not (self._scheduler.expectsTexts()
+                                     or self._parsing):
+                self._flushParsed()
+            self._schedule()
+            #The channels buffer the messages until flushed
+            for channel in [self._toLegi] + self._toDb:
+                channel.flush()
+        if self._pool is not None:
+            #After a failure, articles MAY still be parsed: their results are
+            #read so that the workers do not block on the pipe
+            while self._parsing:
+                self._fromPool.poll(None)
+                self._handleParsed()
+            self._pool.close()
+            self._pool.join()
+        #Store what was parsed before a failure of the Legifrance agent
+        self._flushParsed()
         #All commands have been completed, send shutdown signal
-        for pipe in [toLegi, toDb]:
-            pipe.send(Markers.END)
+        for channel in [self._toLegi] + self._toDb:
+            channel.send(Markers.END)
+            #Also waits for the shared memory segments to be read
+            channel.close()
+        print(self._inFlight.summary())
         fromCommand.send(Markers.END)
 
     def _handleOrder(self):
@@ -459,54 +925,185 @@ class Middleman:
             message = self._fromCommand.recv()
             if message == Markers.END:
                 self._commandsSet.remove("wait")
+            elif isinstance(message, tuple):
+                self._addSearch(message[0], tuple(message[1]))
             elif message in SearchFilters:
-                self._commandsSet.add(message)
-                self._toLegi.send((Markers.TEXT_LIST, message))
+                self._addSearch(message, None)
+    
+    def _addSearch(self, criteria, window):
+        """Register a search, unless its window is already completed."""
+        if _isCompleted(self._completed, criteria, window):
+            return None
+        search = (criteria, window)
+        self._commandsSet.add(search)
+        self._inFlight.addSearch(search)
+        self._scheduler.addSearch(criteria, window)
+    
+    def _updateSearch(self, search, done=0):
+        """
+        Record that done CIDs of a search are processed, and check if the 
+        search is complete.
+        """
+        self._inFlight.done(search, done)
+        if search in self._paginated and not self._inFlight.pending(search):
+            self._paginated.remove(search)
+            self._commandsSet.remove(search)
+            _recordCompletedWindow(self._windowState, self._completed, search)
     
     def _handleLegiMsg(self):
         """React to messages received from the Legifrance connection."""
         while self._toLegi.poll(0):
             message = self._toLegi.recv()
-            if message[0] == Markers.END:
-                #End of a TEXT_LIST command
-                self._commandsSet.remove(message[1])
-            elif message[0] == Markers.TEXT_LIST:
-                #list of CIDs to check
+            if message[0] == Markers.TEXT_LIST:
+                #Message is (TEXT_LIST, filter, CIDs to check, is last page,
+                #window, total number of results)
+                search = (message[1], message[4])
+                split = self._scheduler.pageDone(message[1], message[4], 
+                                                 message[3], message[5],
+                                                 len(message[2]))
+                if split is not None:
+                    #The window is too large: search its halves instead
+                    self._commandsSet.remove(search)
+                    for window in split:
+                        self._addSearch(message[1], window)
+                    continue
+                #Skip the CIDs already being processed by another search
+                cidList = [x for x in message[2] if x not in self._inFlight]
+                if self._known is not None:
+                    #Only the CIDs missing from the snapshot need the DB
+                    cidList = self._known.unknown(cidList)
+                if message[3]:
+                    self._paginated.add(search)
+                if not cidList:
+                    self._updateSearch(search)
+                    continue
                 #Exclude the search filters, the DB does not need it
-                self._toDb.send(message[:1] + message[2:])
-                #Use CID of first element as key, search filter as value
-                try:
-                    self._commandsDict[message[2][0]] = message[1]
-                except KeyError:
-                    print(message)
-                    raise
+                shard = self._dbChecks.index(min(self._dbChecks))
+                self._dbChecks[shard] += 1
+                self._toDb[shard].send((Markers.TEXT_LIST, 
+                                        self._inFlight.startCheck(
+                                            search, len(cidList)),
+                                        cidList))
+                self._scheduler.checkStarted(len(cidList))
             elif message[0] == Markers.TEXT:
                 #Text to parse
                 #Do not remove criteria from commands yet: wait for storage
-                criteria = self._commandsDict[message[1][Types.cid]]
-                text = _parseText(message[1], criteria)
-                self._toDb.send((Markers.TEXT, text))
+                self._scheduler.textDone()
+                cid = message[1][Types.cid]
+                criteria = self._inFlight.search(cid)[0]
+                self._inFlight.move(cid, States.PARSING)
+                if self._pool is None:
+                    self._addParsed(_parseText(message[1], criteria))
+                else:
+                    self._submit(message[1], criteria)
+            elif message[0] == Markers.FAILED:
+                #Message is (FAILED, description of the error)
+                print("Stopping, the Legifrance agent failed: " + message[1])
+                self._failed = True
             else:
                 print("_handleLegiMsg not yet implemented: " + str(message))
     
+    def _submit(self, text, criteria):
+        """Send each article of a text to the parsing workers."""
+        contents = _articles(text)
+        if not contents:
+            self._addParsed(_mergeArticles(text, [], criteria))
+            return None
+        cid = text[Types.cid]
+        self._parsing += 1
+        #Text without its content, results per article, articles to parse,
+        #filter
+        self._articles[cid] = [{Types.cid: cid, Types.publicationDate: 
+                                text[Types.publicationDate],
+                                "contentHash": text.get("contentHash")},
+                               [None] * len(contents), len(contents), 
+                               criteria]
+        for index, content in enumerate(contents):
+            self._pool.apply_async(_parseArticle, (cid, content, criteria),
+                callback=lambda x, cid=cid, index=index: 
+                    self._toSelf.send((cid, index, x)),
+                #Articles that crash the parser are considered as failed
+                error_callback=lambda e, cid=cid, index=index: 
+                    self._toSelf.send((cid, index, None)))
+    
+    def _handleParsed(self):
+        """React to articles parsed by the workers."""
+        while self._pool is not None and self._fromPool.poll(0):
+            #Message is (cid, index of the article, parsing result)
+            cid, index, parsed = self._fromPool.recv()
+            entry = self._articles[cid]
+            entry[1][index] = parsed
+            entry[2] -= 1
+            if not entry[2]:
+                del self._articles[cid]
+                self._parsing -= 1
+                self._addParsed(_mergeArticles(entry[0], entry[1], entry[3]))
+    
+    def _addParsed(self, text):
+        """
+        Buffer a parsed text for the DB agent selected by its CID, and send
+        the buffer to the agent when full.
+        """
+        shard = crc32(text[Types.cid].encode()) % len(self._toDb)
+        self._parsed[shard].append(text)
+        if len(self._parsed[shard]) >= self._batchSize:
+            self._flushParsed(shard)
+    
+    def _flushParsed(self, shard=None):
+        """
+        Send the buffered parsed texts to a DB agent, or to all of them if
+        shard is None.
+        """
+        for index in range(len(self._toDb)) if shard is None else [shard]:
+            if not self._parsed[index]:
+                continue
+            for text in self._parsed[index]:
+                self._inFlight.move(text[Types.cid], States.STORING)
+            self._toDb[index].send((Markers.TEXT, self._parsed[index]))
+            self._parsed[index] = []
+    
+    def _schedule(self):
+        """Send to Legifrance the requests chosen by the scheduler."""
+        request = self._scheduler.next()
+        while request is not None:
+            if request[0] == "page":
+                self._toLegi.send((Markers.TEXT_LIST,) + request[1:])
+            else:
+                self._inFlight.move(request[1], States.DOWNLOADING)
+                self._toLegi.send((Markers.TEXT, request[1]))
+            request = self._scheduler.next()
+    
     def _handleDbMsg(self):
-        """React to messages received from the database connection."""
-        while self._toDb.poll(0):
-            message = self._toDb.recv()
-            if message == Markers.END:
-                #Message sent when _storeText returns, ignore: TEXT suffices.
-                pass
-            elif message[0] == Markers.TEXT_LIST:
-                #Message is (TEXT_LIST, first queried CID, valid CIDs)
+        """React to messages received from the database connections."""
+        for shard, pipe in enumerate(self._toDb):
+            self._handleShardMsg(shard, pipe)
+    
+    def _handleShardMsg(self, shard, pipe):
+        """React to messages received from a database connection."""
+        while pipe.poll(0):
+            message = pipe.recv()
+            if message[0] == Markers.TEXT_LIST:
+                #Message is (TEXT_LIST, request ID, valid CIDs)
                 #List of CIDs to request
-                criteria = self._commandsDict.pop(message[1])
-                if message[2]:
-                    for cid in message[2]:
-                        self._commandsDict[cid] = criteria
-                    self._toLegi.send((Markers.TEXT, message[2]))
+                self._dbChecks[shard] -= 1
+                search, checked = self._inFlight.endCheck(message[1])
+                self._scheduler.checkDone(checked)
+                #Skip the CIDs that another search started processing since
+                cidList = [x for x in message[2] if x not in self._inFlight]
+                for cid in cidList:
+                    self._inFlight.track(cid, search)
+                self._scheduler.addDownloads(cidList)
+                self._updateSearch(search, checked)
             elif message[0] == Markers.TEXT:
-                #Message is (TEXT, cid of the text)
-                self._commandsDict.pop(message[1])
+                #Message is (TEXT, CIDs of the stored texts)
+                for cid in message[1]:
+                    self._updateSearch(self._inFlight.release(cid))
+                    if self._known is not None:
+                        self._known.add(cid)
+                self._scheduler.stored(len(message[1]))
+            elif message[0] == Markers.KNOWN:
+                #Message is (KNOWN, CIDs already stored in the database)
+                self._known = KnownCids(message[1])
             else:
                 print("handleDbMsg not yet implemented: " + str(message))
         
@@ -524,7 +1121,9 @@ class Middleman:
         -------
         bool
             True if there are ongoing tasks and/or if the shutdown signal has
-            not been received yet.
+            not been received yet, and if the Legifrance agent did not fail.
 
         """
-        return bool(self._commandsSet) or bool(self._commandsDict)
\ No newline at end of file
+        if self._failed:
+            return False
+        return bool(self._commandsSet) or not self._inFlight.isIdle()
\ No newline at end of file
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Provide a long-running crawler accepting jobs over a socket.
+
+Starting a crawl costs an OAuth token, the connection to the database, the
+snapshot of the known CIDs and the start of the parsing workers. A daemon
+pays these costs once and keeps them warm between jobs, so that small
+incremental crawls, e.g. the texts published since yesterday, start at once.
+
+A job is a dict with the following keys, all optional:
+    "filters": list of names of SearchFilters members, by default all of them;
+    "since", "until": "YYYY-MM-DD" str, restricting the publication dates of
+        the texts, "until" defaulting to today;
+    "reparse": bool, see asyncCrawler.crawl.
+The str "stop" MAY be sent instead of a job to stop the daemon.
+Only the clients knowing the authentication key of the daemon are accepted.
+For each job, the daemon sends ("progress", metrics) tuples during the job,
+metrics being the dict returned by AsyncCrawler.progress, then either
+("done", metrics) or ("error", message).
+
+Methods
+-------
+serve
+    Run jobs received on a socket with an AsyncCrawler kept open.
+submit
+    Send a job to a daemon and yield its progress.
+parseAddress
+    Convert a "host:port" str or a path to a socket address.
+"""
+from multiprocessing.connection import Listener, Client
+import asyncio
+from datetime import date
+
+STOP = "stop"
+
+def serve(address, crawler, authkey):
+    """
+    Run jobs received on a socket with an AsyncCrawler kept open.
+
+    The jobs are run one at a time, in the order of the connections. This
+    method is blocking and returns when a "stop" message is received.
+    A failed job, or a client that disconnects or sends an invalid message,
+    does not stop the daemon.
+
+    Parameters
+    ----------
+    address : str or tuple
+        Address of the socket, see parseAddress.
+    crawler : AsyncCrawler
+        Crawler running the jobs, not opened yet.
+    authkey : bytes
+        Key that the clients MUST provide. The messages of the clients are 
+        unpickled, which allows them to run arbitrary code: the key is 
+        required even on local sockets.
+
+    Raises
+    ------
+    ValueError
+        If authkey is empty.
+
+    Returns
+    -------
+    None.
+    """
+    if not authkey:
+        raise ValueError("The daemon requires an authentication key")
+    asyncio.run(_serve(address, crawler, authkey))
+
+async def _serve(address, crawler, authkey):
+    """Coroutine running the jobs, see serve."""
+    await crawler.open()
+    try:
+        with Listener(address, authkey=authkey) as listener:
+            print("Waiting for jobs on " + str(listener.address))
+            loop = asyncio.get_running_loop()
+            while True:
+                try:
+                    connection = await loop.run_in_executor(None,
+                                                            listener.accept)
+                except Exception as e:
+                    #E.g. failed authentication
+                    print("Connection refused: " + repr(e))
+                    continue
+                with connection:
+                    try:
+                        job = connection.recv()
+                    except Exception as e:
+                        #E.g. early disconnection or invalid message
+                        print("Invalid job: " + repr(e))
+                        continue
+                    if job == STOP:
+                        connection.send(("done", None))
+                        break
+                    await _runJob(crawler, connection, job)
+    finally:
+        await crawler.close()
+
+async def _runJob(crawler, connection, job):
+    """Run a job and report its progress on the connection."""
+    def progress(metrics):
+        try:
+            connection.send(("progress", metrics))
+        except OSError:
+            #The client left: the job goes on anyway
+            pass
+    try:
+        orders = _orders(job)
+        print("Starting job " + str(job))
+        await crawler.runJob(orders, job.get("reparse", False), progress)
+        message = ("done", crawler.progress())
+    except Exception as e:
+        message = ("error", repr(e))
+    print("Job over: " + str(message))
+    try:
+        connection.send(message)
+    except OSError:
+        pass
+
+def _orders(job):
+    """Convert a job to the orders of AsyncCrawler.runJob."""
+    from legiStructure import SearchFilters
+    names = job.get("filters") or list(SearchFilters.__members__)
+    if job.get("since") is None:
+        return [SearchFilters[name] for name in names]
+    window = (job["since"], job.get("until") or date.today().isoformat())
+    return [(SearchFilters[name], window) for name in names]
+
+def submit(address, job, authkey):
+    """
+    Send a job to a daemon and yield its progress.
+
+    Parameters
+    ----------
+    address : str or tuple
+        Address of the socket of the daemon, see parseAddress.
+    job : dict or str
+        Job, or "stop" to stop the daemon once its current job is over.
+    authkey : bytes
+        Key expected by the daemon.
+
+    Yields
+    ------
+    tuple
+        The messages sent by the daemon, the last one being either
+        ("done", metrics) or ("error", message).
+    """
+    with Client(address, authkey=authkey) as connection:
+        connection.send(job)
+        while True:
+            message = connection.recv()
+            yield message
+            if message[0] != "progress":
+                return None
+
+def parseAddress(text):
+    """
+    Convert a "host:port" str or a path to a socket address.
+
+    Parameters
+    ----------
+    text : str
+        Either "host:port", for a TCP socket, or the path of a Unix socket.
+
+    Returns
+    -------
+    tuple or str
+        (host, port) tuple or path.
+    """
+    host, _, port = text.rpartition(":")
+    if host and port.isdigit():
+        return (host, int(port))
+    return text
@@ -8,6 +8,7 @@ DbConnector
     Class handling the connection to the DB.
 """
 import psycopg2, psycopg2.extras
+import re
 
 class DbConnector:
     """
@@ -16,6 +17,11 @@ class DbConnector:
     SHOULD be used as a context 
     manager in a with-block for several transactions in a row but will work 
     fine even otherwise.
+    
+    The parameterized queries are prepared on first use and kept prepared 
+    for the lifetime of the connection, so that each of them is planned only
+    once per connection. They are prepared again if a new connection is 
+    opened.
     """
     def __init__(self, dbname, user, password, host="127.0.0.1", port="5432"):
         """
@@ -45,6 +51,10 @@ class DbConnector:
         self._port = port
         self._connection = None
         self._nesting = 0
+        #Name of the prepared statement associated with each query
+        self._statements = dict()
+        #Names of the statements prepared on the current connection
+        self._prepared = set()
     
     def __enter__(self):
         if(self._nesting):
@@ -58,6 +68,7 @@ class DbConnector:
                                                 host=self._host,
                                                 port=self._port)
             self._connection.__enter__()
+            self._prepared = set()
             return self
     
     def __exit__(self, exc_type, exc_value, exc_traceback):
@@ -83,6 +94,31 @@ class DbConnector:
             with self._connection.cursor() as cursor:
                 cursor.execute(query)
     
+    def _prepare(self, cursor, query):
+        """
+        Prepare a query on the current connection if it is not already.
+
+        Parameters
+        ----------
+        cursor : psycopg2.extensions.cursor
+            Cursor on the current connection.
+        query : str
+            Parameterized PostgreSQL query, where each parameter is of the form
+            $i with i a counter starting at 1.
+
+        Returns
+        -------
+        str
+            Name of the prepared statement.
+        """
+        if query not in self._statements:
+            self._statements[query] = "stmt" + str(len(self._statements))
+        name = self._statements[query]
+        if name not in self._prepared:
+            cursor.execute("PREPARE " + name + " AS " + query)
+            self._prepared.add(name)
+        return name
+    
     def executeMany(self, query, params):
         """
         Silently execute the given parameterized query against the database.
@@ -108,28 +144,26 @@ class DbConnector:
             return None
         prepared = query.strip().startswith("EXECUTE")
         placeholder = " (" + ",".join(["%s" for x in range(len(params[0]))]) + ")"
-        if not prepared:
-            mainQuery = "EXECUTE stmt" + placeholder
-        else:
-            mainQuery = query
         with self:
             with self._connection.cursor() as cursor:
                 if not prepared:
-                    cursor.execute("PREPARE stmt AS " + query)
+                    mainQuery = "EXECUTE " + self._prepare(cursor, query) \
+                        + placeholder
+                else:
+                    mainQuery = query
                 psycopg2.extras.execute_batch(cursor, mainQuery, params)
-                if not prepared:
-                    cursor.execute("DEALLOCATE stmt")
-                self._executeMany(query, params)
         
                 
     def executeAndFetch(self, query, args=None):
         """
         Execute the given query against the database and return the results.
+        
+        If args is a tuple or a list, the query is prepared on first use.
 
         Parameters
         ----------
         query : str
-            PostgreSQL query.
+            PostgreSQL query, where each parameter is of the form %s.
         args : tuple, optional
             Arguments to pass to the SQL query. The default is None.
 
@@ -141,6 +175,14 @@ class DbConnector:
         """
         with self:
             with self._connection.cursor() as cursor:
+                if isinstance(args, (tuple, list)) and args \
+                        and not query.strip().startswith("EXECUTE"):
+                    counter = iter(range(1, len(args) + 1))
+                    #Use the $i parameters expected by PREPARE
+                    numbered = re.sub(r"%[%s]", lambda x: "%" if x[0] == "%%"
+                                      else "$" + str(next(counter)), query)
+                    query = "EXECUTE " + self._prepare(cursor, numbered) + \
+                        " (" + ",".join(["%s"] * len(args)) + ")"
                 cursor.execute(query, args)
                 return cursor.fetchall()
     
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Provide a way to partition a table of the database by publication date.
+
+This file does not depend on the structure of the database: it applies to any
+table created by dbStructure.initDb that has a publication date column.
+
+Classes
+-------
+PartitionScheme
+    Range partitioning of a table by publication date.
+"""
+from datetime import date, datetime, timezone
+
+class PartitionScheme:
+    """
+    Range partitioning of a table by publication date.
+
+    The table is split in one partition per year or per month of publication,
+    plus a default partition for the dates outside the created partitions. It
+    is indexed on the CID, for the existence checks, and with a BRIN index on
+    the publication date, which keeps range scans on large tables fast at a
+    negligible storage cost.
+    The publication date column MAY either contain Unix timestamps (integer
+    columns) or dates (date and timestamp columns).
+
+    Methods
+    -------
+    partitionTable(dbConnector, indexes)
+        Replace the table with a partitioned copy.
+    ensurePartitions(dbConnector, timestamps)
+        Create the partitions holding the input publication dates.
+    value(dbConnector, timestamp)
+        Convert a Unix timestamp to a value of the publication date column.
+    """
+    _STEPS = ("year", "month")
+    def __init__(self, table, column, step="year"):
+        """
+        Describe the partitioning of a table.
+
+        Parameters
+        ----------
+        table : str
+            Name of the table to partition.
+        column : str
+            Name of the publication date column of the table.
+        step : str, optional
+            Either "year" or "month": the range of publication dates of each
+            partition. The default is "year".
+        """
+        if step not in self._STEPS:
+            raise ValueError("step must be one of " + str(self._STEPS))
+        self.table = table
+        self.column = column
+        self._step = step
+        self._epoch = None
+        #Names of the partitions known to exist
+        self._created = set()
+
+    def _isEpoch(self, dbConnector):
+        """Check if the publication date column contains Unix timestamps."""
+        if self._epoch is None:
+            rows = dbConnector.executeAndFetch(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_name = %s AND column_name = %s",
+                (self.table.lower(), self.column.lower()))
+            self._epoch = bool(rows) and rows[0][0] in ("integer", "bigint")
+        return self._epoch
+
+    def _literal(self, dbConnector, day):
+        """Convert a date to a SQL literal of the publication date column."""
+        if self._isEpoch(dbConnector):
+            return str(int(datetime(day.year, day.month, day.day,
+                                    tzinfo=timezone.utc).timestamp()))
+        return "'" + day.isoformat() + "'"
+
+    def _bounds(self, day):
+        """
+        Compute the partition containing a date.
+
+        Parameters
+        ----------
+        day : datetime.date
+            Publication date.
+
+        Returns
+        -------
+        name : str
+            Name of the partition.
+        lower : datetime.date
+            First date of the partition.
+        upper : datetime.date
+            First date after the partition.
+        """
+        if self._step == "year":
+            lower = date(day.year, 1, 1)
+            upper = date(day.year + 1, 1, 1)
+            suffix = "{:04d}".format(day.year)
+        else:
+            lower = date(day.year, day.month, 1)
+            upper = date(day.year + day.month // 12, day.month % 12 + 1, 1)
+            suffix = "{:04d}_{:02d}".format(day.year, day.month)
+        return self.table + "_" + suffix, lower, upper
+
+    def value(self, dbConnector, timestamp):
+        """
+        Convert a Unix timestamp to a value of the publication date column.
+
+        Parameters
+        ----------
+        dbConnector : DbConnector
+            Connection to the database.
+        timestamp : int
+            Unix timestamp of a publication date.
+
+        Returns
+        -------
+        int or str
+            The timestamp if the column contains timestamps, the date in ISO
+            format otherwise.
+        """
+        if self._isEpoch(dbConnector):
+            return timestamp
+        return _toDate(timestamp).isoformat()
+
+    def ensurePartitions(self, dbConnector, timestamps):
+        """
+        Create the partitions holding the input publication dates.
+
+        This SHOULD be called before inserting rows, so that they are routed
+        to their partition rather than to the default one.
+        Several connections MAY call it concurrently: the creations of
+        partitions are serialised by a single transaction-level advisory lock
+        per table, taken before creating any of them, since a lock per
+        partition would deadlock with the lock that each creation takes on the
+        table. The lock is held until the transaction of dbConnector ends.
+
+        Parameters
+        ----------
+        dbConnector : DbConnector
+            Connection to the database.
+        timestamps : iterable of int
+            Unix timestamps of publication dates.
+
+        Returns
+        -------
+        None.
+        """
+        days = {self._bounds(_toDate(x))[0]: _toDate(x) for x in timestamps}
+        missing = [days[x] for x in sorted(days) if x not in self._created]
+        if not missing:
+            return None
+        #IF NOT EXISTS does not prevent concurrent creations
+        dbConnector.executeAndFetch("SELECT pg_advisory_xact_lock("
+                                    "hashtext(%s))", (self.table,))
+        for day in missing:
+            self._createPartition(dbConnector, day)
+
+    def _createPartition(self, dbConnector, day):
+        """Create the partition containing a date if it does not exist."""
+        name, lower, upper = self._bounds(day)
+        if name in self._created:
+            return None
+        dbConnector.execute(
+            "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+            "FOR VALUES FROM ({}) TO ({})".format(
+                name, self.table, self._literal(dbConnector, lower),
+                self._literal(dbConnector, upper)))
+        self._created.add(name)
+
+    def partitionTable(self, dbConnector, indexes=()):
+        """
+        Replace the table with a partitioned copy.
+
+        The rows of the table are copied in the partitioned table. The
+        constraints of the table are not copied: PostgreSQL does not allow
+        unique constraints that do not include the publication date. The
+        sequences of the serial columns are transferred to the partitioned
+        table.
+
+        Parameters
+        ----------
+        dbConnector : DbConnector
+            Connection to the database.
+        indexes : iterable of str, optional
+            Names of the columns to index, such as the CID. The publication
+            date column is always indexed. The default is ().
+
+        Returns
+        -------
+        None.
+        """
+        old = self.table + "_unpartitioned"
+        with dbConnector:
+            dbConnector.execute("ALTER TABLE {} RENAME TO {}".format(
+                self.table, old))
+            dbConnector.execute(
+                "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) "
+                "PARTITION BY RANGE ({})".format(self.table, old,
+                                                 self.column))
+            dbConnector.execute("CREATE TABLE {0}_default PARTITION OF {0} "
+                                "DEFAULT".format(self.table))
+            first, last = dbConnector.executeAndFetch(
+                "SELECT min({0}), max({0}) FROM {1}".format(self.column,
+                                                           old))[0]
+            if first is not None:
+                day = _toDate(first)
+                while day <= _toDate(last):
+                    self._createPartition(dbConnector, day)
+                    day = self._bounds(day)[2]
+            dbConnector.execute("INSERT INTO {} SELECT * FROM {}".format(
+                self.table, old))
+            #The defaults of the copy still use the sequences of the serial
+            #columns, which would be dropped with the old table
+            for sequence, column in dbConnector.executeAndFetch(
+                    "SELECT d.objid::regclass::text, a.attname "
+                    "FROM pg_depend d JOIN pg_class s ON s.oid = d.objid "
+                    "JOIN pg_attribute a ON a.attrelid = d.refobjid "
+                    "AND a.attnum = d.refobjsubid "
+                    "WHERE d.refobjid = %s::regclass AND d.deptype = 'a' "
+                    "AND s.relkind = 'S'", (old,)):
+                dbConnector.execute("ALTER SEQUENCE {} OWNED BY {}.{}".format(
+                    sequence, self.table, column))
+            dbConnector.execute("DROP TABLE " + old)
+            for column in indexes:
+                dbConnector.execute("CREATE INDEX ON {} ({})".format(
+                    self.table, column))
+            dbConnector.execute("CREATE INDEX ON {} USING brin ({})".format(
+                self.table, self.column))
+            dbConnector.commit()
+
+def _toDate(value):
+    """Convert a Unix timestamp, a date or a datetime to a date."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.fromtimestamp(value, timezone.utc).date()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Provide a compact record of the CIDs being processed.
+
+Classes
+-------
+States
+    Processing states of an in-flight CID.
+InFlightTracker
+    Record the search and the state of each CID being processed.
+"""
+from array import array
+from enum import Enum
+import sys
+
+class States(Enum):
+    """Processing states of an in-flight CID."""
+    QUEUED = 0
+    DOWNLOADING = 1
+    PARSING = 2
+    STORING = 3
+
+class InFlightTracker:
+    """
+    Record the search and the state of each CID being processed.
+
+    Searches, i.e. (filter, window) tuples, are interned: each of them is
+    given an index once, and the number of CIDs of each search still being
+    processed is kept in an array. Each in-flight CID is given a slot, and the
+    index of its search and its state are stored in arrays at this slot. The
+    slots of the released CIDs are reused, so that the arrays never grow 
+    beyond the peak number of in-flight CIDs, and an in-flight CID costs its
+    entry in the dict of the slots and 9 bytes. All the state transitions are
+    O(1).
+    The existence checks of the pages of search results are identified by
+    their own request IDs rather than by the CIDs they contain.
+
+    Methods
+    -------
+    addSearch(search)
+        Register a search.
+    pending(search)
+        Count the CIDs of a search still being processed.
+    done(search, count)
+        Record that CIDs of a search need no more processing.
+    startCheck(search, count), endCheck(requestId)
+        Record the start and end of an existence check of CIDs.
+    track(cid, search, state), move(cid, state), release(cid)
+        Record the start, progress and end of the processing of a CID.
+    search(cid)
+        Get the search of an in-flight CID.
+    isIdle()
+        Check if nothing is being processed.
+    metrics(), summary()
+        Describe the content and the memory footprint of the tracker.
+    """
+    _STATES = len(States)
+    def __init__(self):
+        """Create an empty tracker."""
+        self._searches = []
+        self._searchIndex = dict()
+        #Number of CIDs of each search being checked or processed
+        self._pending = array("q")
+        #Slot of each in-flight CID
+        self._cids = dict()
+        #Search index and state of the CID in each slot, and free slots
+        self._searchOf = array("q")
+        self._stateOf = bytearray()
+        self._free = array("q")
+        #Number of CIDs in each state
+        self._counts = array("q", [0] * self._STATES)
+        #Search and number of CIDs of each existence check
+        self._checks = dict()
+        self._nextRequest = 0
+        self._peak = 0
+
+    def __contains__(self, cid):
+        return cid in self._cids
+
+    def __len__(self):
+        return len(self._cids)
+
+    def addSearch(self, search):
+        """
+        Register a search, with no CID being processed.
+
+        Parameters
+        ----------
+        search : tuple
+            (filter, window) tuple identifying the search.
+
+        Returns
+        -------
+        None.
+        """
+        if search in self._searchIndex:
+            self._pending[self._searchIndex[search]] = 0
+            return None
+        self._searchIndex[search] = len(self._searches)
+        self._searches.append(search)
+        self._pending.append(0)
+
+    def pending(self, search):
+        """Count the CIDs of a search being checked or processed."""
+        return self._pending[self._searchIndex[search]]
+
+    def done(self, search, count=1):
+        """Record that count CIDs of a search need no more processing."""
+        self._pending[self._searchIndex[search]] -= count
+
+    def startCheck(self, search, count):
+        """
+        Record the start of an existence check of CIDs of a search.
+
+        Parameters
+        ----------
+        search : tuple
+            Search of the CIDs.
+        count : int
+            Number of CIDs to check.
+
+        Returns
+        -------
+        int
+            ID of the check request.
+        """
+        self._pending[self._searchIndex[search]] += count
+        requestId = self._nextRequest
+        self._nextRequest += 1
+        self._checks[requestId] = (self._searchIndex[search], count)
+        return requestId
+
+    def endCheck(self, requestId):
+        """
+        Record the end of an existence check.
+
+        Parameters
+        ----------
+        requestId : int
+            ID returned by startCheck.
+
+        Returns
+        -------
+        search : tuple
+            Search of the checked CIDs.
+        count : int
+            Number of checked CIDs, still counted as pending until done is
+            called for them.
+        """
+        index, count = self._checks.pop(requestId)
+        return self._searches[index], count
+
+    def track(self, cid, search, state=States.QUEUED):
+        """
+        Record the start of the processing of a CID.
+
+        The CID is counted as pending for its search until it is released.
+
+        Parameters
+        ----------
+        cid : str
+            CID of the text.
+        search : tuple
+            Search of the CID.
+        state : States, optional
+            State of the CID. The default is States.QUEUED.
+
+        Returns
+        -------
+        None.
+        """
+        index = self._searchIndex[search]
+        if self._free:
+            slot = self._free.pop()
+            self._searchOf[slot] = index
+            self._stateOf[slot] = state.value
+        else:
+            slot = len(self._searchOf)
+            self._searchOf.append(index)
+            self._stateOf.append(state.value)
+        self._cids[cid] = slot
+        self._pending[index] += 1
+        self._counts[state.value] += 1
+        self._peak = max(self._peak, len(self._cids))
+
+    def move(self, cid, state):
+        """Record the new state of an in-flight CID."""
+        slot = self._cids[cid]
+        self._counts[self._stateOf[slot]] -= 1
+        self._counts[state.value] += 1
+        self._stateOf[slot] = state.value
+
+    def search(self, cid):
+        """Get the search of an in-flight CID."""
+        return self._searches[self._searchOf[self._cids[cid]]]
+
+    def release(self, cid):
+        """
+        Record the end of the processing of a CID.
+
+        Parameters
+        ----------
+        cid : str
+            CID of the text.
+
+        Returns
+        -------
+        tuple
+            Search of the CID, whose pending count is decremented.
+        """
+        slot = self._cids.pop(cid)
+        self._free.append(slot)
+        self._counts[self._stateOf[slot]] -= 1
+        index = self._searchOf[slot]
+        self._pending[index] -= 1
+        return self._searches[index]
+
+    def isIdle(self):
+        """Check if no CID is being checked or processed."""
+        return not self._cids and not self._checks
+
+    def metrics(self):
+        """
+        Describe the content and the memory footprint of the tracker.
+
+        Returns
+        -------
+        dict
+            Number of searches ("searches"), of pending checks ("checks"), of
+            in-flight CIDs ("cids") and peak of the latter ("peak"), number of
+            CIDs in each state (name of the state) and approximate size in
+            bytes of the tracker ("bytes"): its structures, the CIDs, the 
+            searches and the slot numbers that are not cached by Python. The
+            CIDs and searches MAY be shared with other objects.
+        """
+        size = sum(sys.getsizeof(x) for x in
+                   (self._searches, self._searchIndex, self._pending, 
+                    self._cids, self._searchOf, self._stateOf, self._free,
+                    self._counts, self._checks))
+        size += sum(sys.getsizeof(x) for x in self._searches)
+        #Only the ints up to 256 are shared objects
+        size += sum(sys.getsizeof(cid) + 
+                    (sys.getsizeof(slot) if slot > 256 else 0) 
+                    for cid, slot in self._cids.items())
+        result = {"searches": len(self._searches), "checks": len(self._checks),
+                  "cids": len(self._cids), "peak": self._peak, "bytes": size}
+        for state in States:
+            result[state.name] = self._counts[state.value]
+        return result
+
+    def summary(self):
+        """Describe the tracker in a human-readable str."""
+        metrics = self.metrics()
+        return "In-flight CIDs: peak {peak}, {cids} left, {searches} " \
+            "searches, {bytes} bytes".format(**metrics)
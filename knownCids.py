@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Provide a compact in-memory index of the CIDs already stored in the database.
+
+Classes
+-------
+KnownCids
+    Sorted index of known CIDs, used to filter CID lists without querying the
+    database.
+"""
+from bisect import bisect_left
+
+class KnownCids:
+    """
+    Sorted index of known CIDs, used to filter CID lists without querying the
+    database.
+
+    The index is a snapshot of the database taken at startup and updated as
+    texts are stored. A CID found in the index is known for sure; a CID not
+    found in it MAY still have been stored by another agent since the
+    snapshot, and SHOULD be confirmed by the database.
+
+    Methods
+    -------
+    add(cid)
+        Record a CID as known.
+    unknown(cidList)
+        Filter out the known CIDs from a list.
+    """
+    #Number of recent additions above which they are merged in the main array
+    _MERGE_THRESHOLD = 4096
+    def __init__(self, cids=()):
+        """
+        Create an index containing the input CIDs.
+
+        Parameters
+        ----------
+        cids : iterable of str, optional
+            CIDs known at creation time. The default is ().
+        """
+        self._sorted = sorted(set(cids))
+        self._recent = set()
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+
+    def __contains__(self, cid):
+        if cid in self._recent:
+            return True
+        index = bisect_left(self._sorted, cid)
+        return index < len(self._sorted) and self._sorted[index] == cid
+
+    def add(self, cid):
+        """
+        Record a CID as known.
+
+        The CID is kept in a small set until enough of them have been added to
+        be merged at once in the sorted array.
+
+        Parameters
+        ----------
+        cid : str
+            CID of a text stored in the database.
+
+        Returns
+        -------
+        None.
+        """
+        if cid in self:
+            return None
+        self._recent.add(cid)
+        if len(self._recent) >= self._MERGE_THRESHOLD:
+            self._sorted = sorted(self._sorted + list(self._recent))
+            self._recent = set()
+
+    def unknown(self, cidList):
+        """
+        Filter out the known CIDs from a list.
+
+        Parameters
+        ----------
+        cidList : list of str
+            CIDs to filter.
+
+        Returns
+        -------
+        list
+            The CIDs from cidList that are not in the index, in the same order.
+        """
+        return [cid for cid in cidList if cid not in self]
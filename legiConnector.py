@@ -8,10 +8,16 @@ time, or quotas MIGHT be violated.
 Classes
 -------
 LegiConnector
+LegiConnectorPool
+HttpTracer
+Cassette
+CassetteMiss
 """
 import requests
 from requests_oauthlib import OAuth2Session
 from time import time, sleep
+from collections import deque
+import gzip, json
 
 class LegiConnector:
     """"
@@ -28,7 +34,8 @@ class LegiConnector:
     _TOKEN_URL = 'https://sandbox-oauth.aife.economie.gouv.fr/api/oauth/token'
     _PERIOD = 60 #number of seconds of the quota
     _QUOTA_LIMIT = 100 #max number of requests in a time period
-    def __init__(self, client_id, client_secret, dummy=False):
+    def __init__(self, client_id, client_secret, dummy=False, tracer=None,
+                 cassette=None):
         """
         Establish a connection to the Legifrance API.
         
@@ -43,6 +50,17 @@ class LegiConnector:
             Client id to request an OAuth2 token from the Legifrance API.
         client_secret : str
             Client secret to request an OAuth2 token from the Legifrance API.
+        dummy : bool, optional
+            If True, the queries are answered by the dummies module instead 
+            of the Legifrance API. The default is False.
+        tracer : HttpTracer, optional
+            If provided, each query sent by post is recorded by the tracer.
+            The default is None.
+        cassette : Cassette, optional
+            If provided, the queries sent by post and their responses are 
+            either recorded in the cassette or, if it is replaying, answered
+            by the cassette instead of the Legifrance API. 
+            The default is None.
 
         Returns
         -------
@@ -52,9 +70,12 @@ class LegiConnector:
         ### TODO: handle invalid login infos
         ### TODO: handle token renewal
         self._dummy = dummy
+        self._tracer = tracer
+        self._cassette = cassette
         self._id = client_id
         self._secret = client_secret
-        if not self._dummy:
+        if not self._dummy and not (cassette is not None and 
+                                    cassette.replaying):
             res = requests.post(
               self._TOKEN_URL,
               data={
@@ -82,13 +103,17 @@ class LegiConnector:
 
         Returns
         -------
-        None.
+        float
+            Number of seconds spent waiting.
         """
         self._checkQuotas()
+        waited = 0
         if(len(self._quotas) >= self._QUOTA_LIMIT):
-            sleep(self._quotas[0] - int(time()) + 1)
+            waited = self._quotas[0] - int(time()) + 1
+            sleep(waited)
         self._checkQuotas()
         self._quotas.append(int(time()) + self._PERIOD)
+        return waited
     
     def _checkQuotas(self):
         """
@@ -106,6 +131,21 @@ class LegiConnector:
             i += 1
         self._quotas = self._quotas[i:]
     
+    def nextSlot(self):
+        """
+        Compute the earliest time at which a query respects the quota.
+
+        Returns
+        -------
+        float
+            Timestamp (as returned by time.time) from which the next query 
+            can be sent without waiting.
+        """
+        self._checkQuotas()
+        if len(self._quotas) >= self._QUOTA_LIMIT:
+            return self._quotas[0] + 1
+        return time()
+    
     def isReady(self):
         """
         Verify that the connection to the Legifrance API is up and running.
@@ -119,7 +159,7 @@ class LegiConnector:
         return self._client.get(LegiConnector._HOST + "/consult/ping")\
             .status_code == 200
         
-    def post(self, path, payload):
+    def post(self, path, payload, fields=None):
         """
         Send a POST query to the Legifrance API.
 
@@ -131,18 +171,60 @@ class LegiConnector:
         payload : dict
             Valid dict representation of the JSON payload parameter expected
             by the queried resource.
+        fields : collection of str, optional
+            If provided, only these fields of the response are extracted, 
+            while it is read incrementally, and the others are discarded 
+            without being decoded. Each field is described by its path in the
+            JSON response, where keys are separated by dots and the elements
+            of a list are designated by "item" (e.g. "articles.item.content").
+            This requires the ijson package: without it, the whole response is
+            decoded. The default is None.
 
         Returns
         -------
         dict
-            Dict representation of the JSON response of the server.
+            Dict representation of the JSON response of the server, pruned of
+            the fields not requested if fields is provided.
         """
-        self._waitIfNeeded(path)
+        if self._cassette is not None and self._cassette.replaying:
+            result, duration = self._cassette.play(path, payload)
+            if self._tracer is not None:
+                self._tracer.record(path, None, 0, 0, duration, 0, 0)
+            return result
+        waited = self._waitIfNeeded(path)
         if self._dummy:
-            return self._dummyResults(path, payload)
+            result = self._dummyResults(path, payload)
+            if self._tracer is not None:
+                self._tracer.record(path, None, 0, 0, 0, waited, 
+                                    len(self._quotas) / self._QUOTA_LIMIT)
+            if self._cassette is not None:
+                self._cassette.record(path, payload, result, waited, 0)
+            return result
+        start = time()
+        response = self._client.post(LegiConnector._HOST + path, json=payload,
+                                     stream=fields is not None)
+        try:
+            import ijson
+        except ImportError:
+            fields = None
+        if fields is None:
+            result = response.json()
+            size = len(response.content)
         else:
-            return self._client.post(
-                LegiConnector._HOST + path, json=payload).json()
+            with response:
+                response.raw.decode_content = True
+                reader = _CountingReader(response.raw)
+                result = _prune(ijson.parse(reader, use_float=True), fields)
+                size = reader.size
+        if self._tracer is not None:
+            self._tracer.record(path, response.status_code, size,
+                                response.elapsed.total_seconds(),
+                                time() - start, waited,
+                                len(self._quotas) / self._QUOTA_LIMIT)
+        if self._cassette is not None:
+            self._cassette.record(path, payload, result, waited, 
+                                  time() - start)
+        return result
     
     def _dummyResults(self, path, payload):
         """
@@ -166,4 +248,409 @@ class LegiConnector:
             return dummies.getCidList(payload["recherche"]["pageNumber"], 
                                       payload["recherche"]["pageSize"])
         elif path == "/consult/jorf":
-            return dummies.getText(payload["textCid"])
\ No newline at end of file
+            return dummies.getText(payload["textCid"])
+
+class _CountingReader:
+    """File-like wrapper counting the bytes read from another file-like."""
+    def __init__(self, raw):
+        self._raw = raw
+        self.size = 0
+    
+    def read(self, size=-1):
+        data = self._raw.read(size)
+        self.size += len(data)
+        return data
+
+def _prune(events, fields):
+    """
+    Build a JSON object containing only some fields from parsing events.
+
+    Parameters
+    ----------
+    events : iterable
+        Events as yielded by ijson.parse: tuples (prefix, event, value).
+    fields : collection of str
+        Prefixes of the scalar values to keep, as described in 
+        LegiConnector.post.
+
+    Returns
+    -------
+    dict
+        Dict with the same structure as the complete JSON object, but 
+        containing only the requested fields and the containers leading to 
+        them.
+    """
+    fields = set(fields)
+    #Prefixes of the maps and lists containing requested fields
+    containers = {field.rsplit(".", i)[0] for field in fields 
+                  for i in range(1, field.count(".") + 1)}
+    result = {}
+    stack = [result]
+    for prefix, event, value in events:
+        if prefix in fields and event not in ("start_map", "start_array",
+                                             "end_map", "end_array", 
+                                             "map_key"):
+            _insert(stack[-1], prefix, value)
+        elif prefix in containers:
+            if event in ("start_map", "start_array"):
+                container = {} if event == "start_map" else []
+                _insert(stack[-1], prefix, container)
+                stack.append(container)
+            elif event in ("end_map", "end_array"):
+                stack.pop()
+    return result
+
+def _insert(container, prefix, value):
+    """Insert a value in a container at the position given by its prefix."""
+    key = prefix.rpartition(".")[2]
+    if isinstance(container, list):
+        container.append(value)
+    else:
+        container[key] = value
+
+class LegiConnectorPool:
+    """
+    Dispatch requests to the Legifrance API over several login infos.
+    
+    Each pair of login infos gets its own LegiConnector, hence its own token
+    and its own quota. Each query is sent through the connector whose quota
+    frees a slot first, so that the throughput grows linearly with the number
+    of login infos.
+    
+    Methods
+    -------
+    isReady():
+        Verify that the connections to the Legifrance API are up and running.
+    post(path, payload):
+        Send a POST query to the Legifrance API.
+    """
+    def __init__(self, credentials, dummy=False, tracer=None, cassette=None):
+        """
+        Establish one connection to the Legifrance API per pair of login infos.
+
+        Parameters
+        ----------
+        credentials : iterable of tuples
+            Each element is a (client_id, client_secret) pair, as expected by
+            LegiConnector. The same pair MUST NOT appear twice, or quotas 
+            MIGHT be violated.
+        dummy : bool, optional
+            Passed to each LegiConnector. The default is False.
+        tracer : HttpTracer, optional
+            Passed to each LegiConnector. The default is None.
+        cassette : Cassette, optional
+            Passed to each LegiConnector. The default is None.
+
+        Returns
+        -------
+        A LegiConnectorPool object ready to make requests, assuming that the 
+        login infos are valid.
+        """
+        self._connectors = [LegiConnector(client_id, client_secret, dummy,
+                                          tracer, cassette)
+                            for client_id, client_secret in credentials]
+        if not self._connectors:
+            raise ValueError("At least one pair of login infos is required")
+    
+    def _select(self):
+        """Return the connector that can send a query the soonest."""
+        return min(self._connectors, key=lambda x: x.nextSlot())
+    
+    def isReady(self):
+        """
+        Verify that the connections to the Legifrance API are up and running.
+
+        Returns
+        -------
+        bool
+            True if all the connections are OK, false otherwise.
+        """
+        return all(connector.isReady() for connector in self._connectors)
+    
+    def post(self, path, payload, fields=None):
+        """
+        Send a POST query to the Legifrance API.
+        
+        The query is sent through the connector with the earliest available
+        slot in its quota.
+
+        Parameters
+        ----------
+        path : str
+            Path to the resource to query. See LegiConnector.post.
+        payload : dict
+            Valid dict representation of the JSON payload parameter expected
+            by the queried resource.
+        fields : collection of str, optional
+            Fields of the response to extract. See LegiConnector.post.
+            The default is None.
+
+        Returns
+        -------
+        dict
+            Dict representation of the JSON response of the server.
+        """
+        return self._select().post(path, payload, fields)
+
+
+class HttpTracer:
+    """
+    Record statistics on the queries sent to the Legifrance API.
+    
+    For each query, the tracer records the path, the response status, the 
+    number of bytes received, the server latency (time until the response
+    headers are received), the total duration of the query, the time spent
+    waiting for the quota and the use of the quota in the current period.
+    These records are aggregated by path and MAY also be written, one JSON
+    object per line, in a trace file.
+    
+    Methods
+    -------
+    record(path, status, size, latency, duration, waited, quotaUse)
+        Record a query.
+    summary()
+        Describe the aggregated statistics per path.
+    close()
+        Close the trace file.
+    """
+    #Upper bounds of the latency histogram buckets, in milliseconds
+    _BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+    def __init__(self, traceFile=None):
+        """
+        Create a tracer with no recorded query.
+
+        Parameters
+        ----------
+        traceFile : str, optional
+            Path to the file where each query is written. If None, the queries
+            are only aggregated. The default is None.
+        """
+        self._traceFile = traceFile
+        self._file = None
+        self._paths = dict()
+    
+    def record(self, path, status, size, latency, duration, waited, quotaUse):
+        """
+        Record a query.
+
+        Parameters
+        ----------
+        path : str
+            Path of the queried resource.
+        status : int or None
+            HTTP status of the response, None for mocked responses.
+        size : int
+            Number of bytes received.
+        latency : float
+            Number of seconds until the response headers were received.
+        duration : float
+            Number of seconds until the response was completely read.
+        waited : float
+            Number of seconds spent waiting for the quota before the query.
+        quotaUse : float
+            Share of the quota used in the current period, this query 
+            included.
+
+        Returns
+        -------
+        None.
+        """
+        stats = self._paths.setdefault(path, {
+            "count": 0, "statuses": dict(), "bytes": 0, "latency": 0,
+            "duration": 0, "waited": 0, "quotaUse": 0,
+            "histogram": [0] * (len(self._BUCKETS) + 1)})
+        stats["count"] += 1
+        stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+        stats["bytes"] += size
+        stats["latency"] += latency
+        stats["duration"] += duration
+        stats["waited"] += waited
+        stats["quotaUse"] += quotaUse
+        bucket = 0
+        while bucket < len(self._BUCKETS) and \
+                latency * 1000 >= self._BUCKETS[bucket]:
+            bucket += 1
+        stats["histogram"][bucket] += 1
+        if self._traceFile is not None:
+            if self._file is None:
+                self._file = open(self._traceFile, "a")
+            self._file.write(json.dumps({
+                "time": time(), "path": path, "status": status, 
+                "bytes": size, "latency": latency, "duration": duration,
+                "waited": waited, "quotaUse": quotaUse}) + "\n")
+    
+    def summary(self):
+        """
+        Describe the aggregated statistics per path.
+
+        Returns
+        -------
+        str
+            Human-readable description of the statistics.
+        """
+        lines = []
+        for path, stats in self._paths.items():
+            count = stats["count"]
+            lines.append("{}: {} queries, {} bytes, statuses {}".format(
+                path, count, stats["bytes"], stats["statuses"]))
+            lines.append(("  quota wait {:.1f} s, server {:.1f} s, transfer "
+                          "{:.1f} s, mean quota use {:.0%}").format(
+                stats["waited"], stats["latency"], 
+                stats["duration"] - stats["latency"], 
+                stats["quotaUse"] / count))
+            bounds = ["<{}ms".format(x) for x in self._BUCKETS] + \
+                [">={}ms".format(self._BUCKETS[-1])]
+            lines.append("  latency " + " ".join(
+                "{}:{}".format(bound, number) for bound, number 
+                in zip(bounds, stats["histogram"]) if number))
+        return "\n".join(lines)
+    
+    def close(self):
+        """Close the trace file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class CassetteMiss(KeyError):
+    """Query absent from the cassette being replayed."""
+
+class Cassette:
+    """
+    Record the queries sent to the Legifrance API and replay them offline.
+    
+    A cassette is a gzip-compressed file containing one compact JSON object
+    per query: its path, its payload, the response (pruned of the fields that
+    were not requested), the time spent waiting for the quota and the 
+    duration of the query. A crawl recorded once MAY then be replayed as many
+    times as needed, without login infos nor quota, e.g. to benchmark the 
+    parsing and the database. The replayed crawl MUST send the same queries:
+    same filters, page sizes and windows.
+    
+    The file is only opened on first use, so that the object can be sent to
+    the process in charge of Legifrance.
+    
+    Methods
+    -------
+    record(path, payload, response, waited, duration)
+        Record a query and its response.
+    play(path, payload)
+        Answer a query with the recorded response.
+    close()
+        Close the cassette file.
+    """
+    def __init__(self, path, replaying=False, timeScale=0):
+        """
+        Create a cassette.
+
+        Parameters
+        ----------
+        path : str
+            Path to the cassette file. When recording, the queries are 
+            appended to it.
+        replaying : bool, optional
+            If True, the cassette answers the queries, otherwise it records
+            them. The default is False.
+        timeScale : float, optional
+            When replaying, each query takes the time it took when recorded,
+            quota waiting included, multiplied by timeScale. If 0, the queries
+            are answered at once. The default is 0.
+        """
+        self._path = path
+        self.replaying = replaying
+        self._timeScale = timeScale
+        self._file = None
+        #Recorded responses to each query, in order
+        self._responses = None
+    
+    @staticmethod
+    def _key(path, payload):
+        """Identify a query by its path and canonical payload."""
+        return path + " " + json.dumps(payload, sort_keys=True)
+    
+    def record(self, path, payload, response, waited, duration):
+        """
+        Record a query and its response.
+
+        Parameters
+        ----------
+        path : str
+            Path of the queried resource.
+        payload : dict
+            Payload of the query.
+        response : dict
+            Response to the query, as returned by LegiConnector.post.
+        waited : float
+            Number of seconds spent waiting for the quota before the query.
+        duration : float
+            Number of seconds spent on the query.
+
+        Returns
+        -------
+        None.
+        """
+        if self._file is None:
+            self._file = gzip.open(self._path, "at", encoding="utf-8")
+        self._file.write(json.dumps({
+            "path": path, "payload": payload, "response": response,
+            "waited": round(waited, 3), "duration": round(duration, 3)},
+            separators=(",", ":")) + "\n")
+    
+    def _load(self):
+        """Read the recorded queries."""
+        self._responses = dict()
+        with gzip.open(self._path, "rt", encoding="utf-8") as file:
+            try:
+                for line in file:
+                    entry = json.loads(line)
+                    self._responses.setdefault(
+                        self._key(entry["path"], entry["payload"]),
+                        deque()).append((entry["response"], 
+                                         entry["waited"] + entry["duration"]))
+            except (EOFError, ValueError):
+                #The end of a cassette whose recording crashed is lost
+                pass
+    
+    def play(self, path, payload):
+        """
+        Answer a query with the recorded response.
+        
+        A query recorded several times is answered with its responses in 
+        order, the last one being reused.
+
+        Parameters
+        ----------
+        path : str
+            Path of the queried resource.
+        payload : dict
+            Payload of the query.
+
+        Raises
+        ------
+        CassetteMiss
+            If the query was not recorded.
+
+        Returns
+        -------
+        response : dict
+            Recorded response.
+        duration : float
+            Number of seconds spent replaying the query.
+        """
+        if self._responses is None:
+            self._load()
+        key = self._key(path, payload)
+        if key not in self._responses:
+            raise CassetteMiss("Query not recorded in the cassette: " + key)
+        responses = self._responses[key]
+        response, duration = responses.popleft() if len(responses) > 1 \
+            else responses[0]
+        duration *= self._timeScale
+        if duration:
+            sleep(duration)
+        return response, duration
+    
+    def close(self):
+        """Close the cassette file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
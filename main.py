@@ -2,47 +2,370 @@
 """
 See the README.md file for the prerequisites to run this file.
 
-For the first run, set init_db to True, and then to False.
+Run "python main.py --help" to list the available options. Options MAY be
+grouped in named profiles defined in a configuration file (by default
+profiles.ini), selected with --profile; options given on the command line
+override those of the profile.
+
+For the first run, use the --init-db option.
 Running this file will send some tableaux d'avancement to the database, and
 most likely send some CIDs to the failedTexts table.
 
-Spyder encounters an issue with multiprocessing. If you want to run this file
-from Spyder, it must be run in an external terminal. To do that: 
+Spyder encounters an issue with multiprocessing, and its console already runs
+an event loop, which prevents the --single-process option from running. If you
+want to crawl from Spyder, either await asyncCrawler.crawlAsync in its console
+or run this file in an external terminal. To do that:
 Run > Configuration per file > Execute in an external system terminal
 """
 from converter import createTextProvider, createDbManager, Middleman
+import argparse, configparser, sys
+from datetime import date
 
-if __name__ == "__main__":
-    from multiprocessing import Process, Pipe
-    init_db = False
-    runTest = True
-    import secret
-    from converter import SearchFilters, Markers
-    if init_db:
+#Options that do not take a value
+_FLAGS = {"init-db", "no-crawl", "single-process", "reparse", "dummy",
+          "trace"}
+
+def _parseArguments(argv):
+    """
+    Parse the command line arguments, completed by the selected profile.
+
+    Parameters
+    ----------
+    argv : list of str
+        Command line arguments, without the name of the program.
+
+    Returns
+    -------
+    argparse.Namespace
+        The options of the run.
+    """
+    from legiStructure import SearchFilters
+    parser = argparse.ArgumentParser(
+        description="Crawl Legifrance and store the parsed texts.")
+    parser.add_argument("--config", default="profiles.ini",
+                        help="configuration file defining the profiles")
+    parser.add_argument("--profile",
+                        help="name of the profile to use in the config file")
+    parser.add_argument("--init-db", action="store_true",
+                        help="initialise the types and tables of the DB")
+    parser.add_argument("--partition-table",
+                        help="name of the records table, partitioned by "
+                        "publication date (with --init-db, the table created "
+                        "by initDb is converted to a partitioned one)")
+    parser.add_argument("--partition-step", choices=["year", "month"],
+                        default="year",
+                        help="range of publication dates of each partition "
+                        "(default: year)")
+    parser.add_argument("--no-crawl", action="store_true",
+                        help="do not query Legifrance")
+    parser.add_argument("--single-process", action="store_true",
+                        help="crawl from an asyncio event loop in the "
+                        "current process instead of three processes, e.g. "
+                        "for short runs or to profile them")
+    parser.add_argument("--reparse", action="store_true",
+                        help="instead of searching Legifrance, parse again "
+                        "the stored texts of the filters whose structures "
+                        "changed since they were parsed (implies "
+                        "--single-process)")
+    parser.add_argument("--daemon", metavar="ADDRESS",
+                        help="keep the connections and the parsing workers "
+                        "open and run the jobs received on this socket "
+                        "(host:port or path) until stopped (implies "
+                        "--single-process)")
+    parser.add_argument("--submit", metavar="ADDRESS",
+                        help="send the job set by --filters, --since, "
+                        "--until and --reparse to the daemon listening on "
+                        "this socket and print its progress")
+    parser.add_argument("--stop-daemon", metavar="ADDRESS",
+                        help="stop the daemon listening on this socket once "
+                        "its current job is over")
+    parser.add_argument("--filters", nargs="+",
+                        choices=list(SearchFilters.__members__),
+                        default=list(SearchFilters.__members__),
+                        help="search filters to crawl (default: all)")
+    parser.add_argument("--parse-workers", type=int, default=0,
+                        help="number of parsing processes (default: 0, the "
+                        "texts are parsed by the middleman process)")
+    parser.add_argument("--db-batch-size", type=int, default=1,
+                        help="number of texts stored at once (default: 1)")
+    parser.add_argument("--db-writers", type=int, default=1,
+                        help="number of processes storing the texts, each "
+                        "with its own connection (default: 1)")
+    parser.add_argument("--page-size", type=int,
+                        help="number of CIDs per page of search results "
+                        "(default: the page size of each filter)")
+    parser.add_argument("--max-in-flight", type=int,
+                        help="maximum number of texts requested and not "
+                        "stored yet (default: no limit)")
+    parser.add_argument("--since",
+                        help="only crawl the texts published since this "
+                        "date (YYYY-MM-DD), split in windows of publication "
+                        "dates searched independently (without it, the "
+                        "searches are not split)")
+    parser.add_argument("--until", default=date.today().isoformat(),
+                        help="with --since, only crawl the texts published "
+                        "until this date (YYYY-MM-DD, default: today)")
+    parser.add_argument("--window-pages", type=int, default=5,
+                        help="maximum number of pages of search results per "
+                        "window of publication dates (default: 5)")
+    parser.add_argument("--window-state",
+                        help="file recording the completed windows of "
+                        "publication dates, skipped when restarting")
+    parser.add_argument("--output-dir",
+                        help="store the results in Parquet files in this "
+                        "directory instead of the DB, e.g. to crawl offline")
+    parser.add_argument("--dummy", action="store_true",
+                        help="use dummies.py instead of querying Legifrance")
+    parser.add_argument("--record",
+                        help="record the queries to Legifrance and their "
+                        "responses in this cassette file")
+    parser.add_argument("--replay",
+                        help="answer the queries to Legifrance from this "
+                        "cassette file instead of querying Legifrance")
+    parser.add_argument("--replay-time-scale", type=float, default=0,
+                        help="with --replay, each query takes the time it "
+                        "took when recorded multiplied by this factor "
+                        "(default: 0, no waiting)")
+    parser.add_argument("--profiling", choices=["cprofile", "sampling"],
+                        help="profile each process with cProfile or a "
+                        "sampling profiler, and print the top functions of "
+                        "each process at the end")
+    parser.add_argument("--profiling-dir", default="profiling",
+                        help="directory where the profile of each process is "
+                        "written (default: profiling)")
+    parser.add_argument("--trace", action="store_true",
+                        help="print statistics on the queries to Legifrance")
+    parser.add_argument("--trace-file",
+                        help="write each query to Legifrance in this file "
+                        "(implies --trace)")
+    options, _ = parser.parse_known_args(argv)
+    if options.profile is None:
+        return parser.parse_args(argv)
+    config = configparser.ConfigParser()
+    if not config.read(options.config):
+        parser.error("cannot read config file " + options.config)
+    if not config.has_section(options.profile):
+        parser.error("unknown profile " + options.profile)
+    #The profile is converted in arguments placed before the command line
+    #ones, so that the latter take precedence
+    profile = []
+    for key, value in config.items(options.profile):
+        if key in _FLAGS:
+            if config.getboolean(options.profile, key):
+                profile.append("--" + key)
+        else:
+            profile.append("--" + key)
+            profile.extend(value.split())
+    return parser.parse_args(profile + argv)
+
+def run(options):
+    """
+    Initialise the database and/or crawl Legifrance as set by the options.
+
+    Parameters
+    ----------
+    options : argparse.Namespace
+        Options as returned by _parseArguments.
+
+    Returns
+    -------
+    None.
+    """
+    from multiprocessing import Pipe
+    from converter import Markers
+    if options.submit is not None or options.stop_daemon is not None:
+        _submit(options)
+        return None
+    partitions = None
+    if options.partition_table is not None:
+        from dbPartitions import PartitionScheme
+        from dbStructure import Types
+        partitions = PartitionScheme(options.partition_table,
+                                     Types.publicationDate.name,
+                                     options.partition_step)
+    if options.init_db:
         print("Initialising DB")
+        import secret
         from dbStructure import initDb
         from dbConnector import DbConnector
-        initDb(DbConnector(secret.DB_NAME, secret.DB_USER, secret.DB_PW))
+        connector = DbConnector(secret.DB_NAME, secret.DB_USER, secret.DB_PW)
+        initDb(connector)
+        if partitions is not None:
+            partitions.partitionTable(connector, [Types.cid.name])
         print("DB initialised")
-    if runTest:
+    if not options.no_crawl and options.daemon is not None:
+        _serve(options, partitions)
+    elif not options.no_crawl and (options.single_process or 
+                                   options.reparse):
+        _crawlInProcess(options, partitions)
+    elif not options.no_crawl:
         print("Setting up query process")
         legi1, legi2 = Pipe(True)
-        db1, db2 = Pipe(True)
+        dbPipes = [Pipe(True) for _ in range(max(1, options.db_writers))]
         command1, command2 = Pipe(True)
-        legiProcess = Process(target=createTextProvider, 
-                              args=((secret.CLIENT_ID, secret.CLIENT_SECRET),
-                                    legi2))
-        dbProcess = Process(target=createDbManager,
-                            args=((secret.DB_NAME, secret.DB_USER, secret.DB_PW),
-                                  db2))
-        middleProcess = Process(target=Middleman.create,
-                                args=(legi1, db1, command1))
-        for query in SearchFilters:
-            command2.send(query)
+        legiProcess = _process(options, "legifrance", createTextProvider,
+                               (_credentials(options), legi2,
+                                options.page_size,
+                                options.trace_file or options.trace,
+                                _cassette(options)))
+        #Each writer gets its own copy of the storage, hence its connection
+        storage = _storage(options, partitions)
+        dbProcesses = [_process(options, "database" if len(dbPipes) == 1 
+                                else "database-" + str(i), createDbManager,
+                                (storage, pipe[1], i == 0))
+                       for i, pipe in enumerate(dbPipes)]
+        middleProcess = _process(options, "middleman", Middleman.create,
+                                 (legi1, [x[0] for x in dbPipes], command1,
+                                  options.parse_workers,
+                                  options.db_batch_size,
+                                  options.max_in_flight,
+                                  options.window_pages,
+                                  options.window_state))
+        for order in _orders(options):
+            command2.send(order)
         command2.send(Markers.END)
         print("Starting processes")
-        for p in (middleProcess, legiProcess, dbProcess):
+        for p in [middleProcess, legiProcess] + dbProcesses:
             p.start()
-        for p in (middleProcess, legiProcess, dbProcess):
+        #Only the agents keep the pipes open, so that each of them sees when
+        #another one stops
+        for pipe in [legi1, legi2, command1] + [x for y in dbPipes for x in y]:
+            pipe.close()
+        for p in [middleProcess, legiProcess] + dbProcesses:
             p.join()
-        print("All done!")
\ No newline at end of file
+        if any(p.exitcode for p in [middleProcess, legiProcess] +
+               dbProcesses):
+            sys.exit("An agent failed, the crawl is incomplete")
+        print("All done!")
+    if options.profiling is not None and not options.no_crawl:
+        from profiling import summarise
+        print(summarise(options.profiling_dir))
+
+def _process(options, label, target, args):
+    """
+    Create a process running target(*args), profiled if set by the options.
+
+    Parameters
+    ----------
+    options : argparse.Namespace
+        Options as returned by _parseArguments.
+    label : str
+        Name of the profile of the process.
+    target : function
+        Function run by the process.
+    args : tuple
+        Arguments of the function.
+
+    Returns
+    -------
+    multiprocessing.Process
+        The process, not started.
+    """
+    from multiprocessing import Process
+    if options.profiling is None:
+        return Process(target=target, args=args)
+    from profiling import runProfiled, Profilers
+    return Process(target=runProfiled, 
+                   args=(options.profiling_dir, Profilers(options.profiling),
+                         label, target) + args)
+
+def _credentials(options):
+    """Select the login infos to Legifrance set by the options."""
+    if options.replay is not None and not options.dummy:
+        #The cassette answers the queries: no token is requested
+        return (None, None)
+    import secret
+    if options.dummy:
+        return (secret.CLIENT_ID, secret.CLIENT_SECRET, True)
+    #Several pairs of login infos multiply the available quota
+    return getattr(secret, "CREDENTIALS",
+                   (secret.CLIENT_ID, secret.CLIENT_SECRET))
+
+def _cassette(options):
+    """Create the cassette set by the options, if any."""
+    if options.record is None and options.replay is None:
+        return None
+    from legiConnector import Cassette
+    if options.replay is not None:
+        return Cassette(options.replay, True, options.replay_time_scale)
+    return Cassette(options.record)
+
+def _storage(options, partitions):
+    """Create the destination of the parsing results set by the options."""
+    if options.output_dir is None:
+        import secret
+        from sinks import PostgresSink
+        return PostgresSink(secret.DB_NAME, secret.DB_USER, secret.DB_PW,
+                            partitions=partitions)
+    from sinks import ParquetSink
+    return ParquetSink(options.output_dir)
+
+def _orders(options):
+    """List the searches to run set by the options."""
+    from legiStructure import SearchFilters
+    if options.since is None:
+        return [SearchFilters[name] for name in options.filters]
+    return [(SearchFilters[name], (options.since, options.until))
+            for name in options.filters]
+
+def _crawlInProcess(options, partitions):
+    """Crawl Legifrance from the current process, see asyncCrawler."""
+    from asyncCrawler import crawl
+    print("Crawling")
+    args = (_credentials(options), _storage(options, partitions),
+            _orders(options), options.parse_workers, options.db_batch_size,
+            options.max_in_flight, options.window_pages, options.window_state,
+            options.page_size, options.trace_file or options.trace,
+            options.reparse, _cassette(options))
+    if options.profiling is None:
+        crawl(*args)
+    else:
+        from profiling import runProfiled, Profilers
+        runProfiled(options.profiling_dir, Profilers(options.profiling),
+                    "crawl", crawl, *args)
+    print("All done!")
+
+def _serve(options, partitions):
+    """Run a daemon crawling Legifrance from the current process."""
+    from asyncCrawler import AsyncCrawler
+    from daemon import serve, parseAddress
+    crawler = AsyncCrawler(_credentials(options), 
+                           _storage(options, partitions),
+                           options.parse_workers, options.db_batch_size,
+                           options.max_in_flight, options.window_pages,
+                           options.window_state, options.page_size,
+                           options.trace_file or options.trace,
+                           _cassette(options))
+    args = (parseAddress(options.daemon), crawler, _authkey())
+    if options.profiling is None:
+        serve(*args)
+    else:
+        from profiling import runProfiled, Profilers
+        runProfiled(options.profiling_dir, Profilers(options.profiling),
+                    "daemon", serve, *args)
+    print("Daemon stopped")
+
+def _submit(options):
+    """Send the job set by the options to a daemon, see daemon.submit."""
+    from daemon import submit, parseAddress, STOP
+    if options.stop_daemon is not None:
+        address, job = options.stop_daemon, STOP
+    else:
+        address = options.submit
+        job = {"filters": options.filters, "since": options.since,
+               "until": options.until, "reparse": options.reparse}
+    for kind, metrics in submit(parseAddress(address), job, _authkey()):
+        if kind == "error":
+            print("Job failed: " + metrics)
+        elif metrics is not None:
+            print("{}: {pages} pages, {stored} texts stored, {cids} in "
+                  "flight".format(kind, **metrics))
+
+def _authkey():
+    """Get the key shared by the daemon and its clients, None if unset."""
+    import secret
+    key = getattr(secret, "DAEMON_KEY", None)
+    return key.encode() if isinstance(key, str) else key
+
+if __name__ == "__main__":
+    run(_parseArguments(sys.argv[1:]))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Provide a way to profile each process of a crawl.
+
+Classes
+-------
+Profilers
+    Available profilers.
+
+Methods
+-------
+runProfiled
+    Run a function under a profiler and write the profile in a file.
+summarise
+    Describe the top functions of each profile written in a directory.
+"""
+from collections import Counter
+from enum import Enum
+import os, sys, threading, time
+
+class Profilers(Enum):
+    """
+    Available profilers.
+
+    DETERMINISTIC: cProfile, recording every function call. The profile is
+    written in a "<label>.prof" file readable by pstats or snakeviz.
+
+    SAMPLING: stacks of all the threads of the process, sampled at regular
+    intervals of wall-clock time, which barely slows the process down. Time
+    spent waiting, e.g. for a pipe or the quota, is sampled as well. The
+    profile is written in a "<label>.samples" file, one "thread;caller;...;
+    callee count" line per distinct stack, readable by flame graph tools.
+    """
+    DETERMINISTIC = "cprofile"
+    SAMPLING = "sampling"
+
+#Seconds between two samples of the sampling profiler
+_INTERVAL = 0.005
+
+def runProfiled(directory, profiler, label, target, *args):
+    """
+    Run a function under a profiler and write the profile in a file.
+
+    This function MAY be used as the target of a multiprocessing.Process, the
+    profile being written when the process ends.
+
+    Parameters
+    ----------
+    directory : str
+        Directory where the profile is written. It will be created if
+        necessary.
+    profiler : Profilers
+        Profiler to use.
+    label : str
+        Name of the profile file, without its extension.
+    target : function
+        Function to run.
+    *args
+        Arguments of the function.
+
+    Returns
+    -------
+    object
+        The return value of target.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if profiler == Profilers.DETERMINISTIC:
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(target, *args)
+        finally:
+            profile.dump_stats(os.path.join(directory, label + ".prof"))
+    sampler = _Sampler()
+    sampler.start()
+    try:
+        return target(*args)
+    finally:
+        sampler.stop()
+        sampler.write(os.path.join(directory, label + ".samples"))
+
+class _Sampler(threading.Thread):
+    """Thread sampling the stacks of the other threads of the process."""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self._stacks = Counter()
+        self._running = threading.Event()
+
+    def run(self):
+        self._running.set()
+        names = dict()
+        while self._running.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                if ident not in names:
+                    names = {x.ident: x.name for x in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[";".join(reversed(stack))] += 1
+            time.sleep(_INTERVAL)
+
+    def stop(self):
+        """Stop sampling."""
+        self._running.clear()
+        self.join()
+
+    def write(self, path):
+        """Write the sampled stacks in a file."""
+        with open(path, "w") as file:
+            for stack, count in self._stacks.most_common():
+                file.write("{} {}\n".format(stack, count))
+
+def summarise(directory, top=10):
+    """
+    Describe the top functions of each profile written in a directory.
+
+    Parameters
+    ----------
+    directory : str
+        Directory where the profiles were written by runProfiled.
+    top : int, optional
+        Number of functions listed per profile. The default is 10.
+
+    Returns
+    -------
+    str
+        For each deterministic profile, the functions with the largest
+        cumulative time; for each sampling profile, the functions with the
+        most samples, with the share of the samples where they are running
+        (self) and on the stack (total).
+    """
+    import pstats, io
+    lines = []
+    for file in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file)
+        label, extension = os.path.splitext(file)
+        if extension == ".prof":
+            output = io.StringIO()
+            pstats.Stats(path, stream=output).sort_stats("cumulative")\
+                .print_stats(top)
+            lines.append("== " + label + " (cprofile)")
+            lines.extend(x for x in output.getvalue().splitlines()
+                         if x.strip() and not x.startswith("   Ordered"))
+        elif extension == ".samples":
+            selfCounts, totalCounts, samples = Counter(), Counter(), 0
+            with open(path) as profile:
+                for line in profile:
+                    stack, count = line.rsplit(" ", 1)
+                    count = int(count)
+                    functions = stack.split(";")[1:]
+                    samples += count
+                    if functions:
+                        selfCounts[functions[-1]] += count
+                    for function in set(functions):
+                        totalCounts[function] += count
+            lines.append("== {} (sampling, {} samples)".format(label,
+                                                              samples))
+            for function, count in selfCounts.most_common(top):
+                lines.append("  {:6.1%} self {:6.1%} total  {}".format(
+                    count / samples, totalCounts[function] / samples,
+                    function))
+    return "\n".join(lines)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Provide a way to decide what to request next from the Legifrance API.
+
+Classes
+-------
+Scheduler
+    Decide how to spend each request allowed by the Legifrance quota.
+"""
+from collections import deque
+from datetime import date, timedelta
+
+class Scheduler:
+    """
+    Decide how to spend each request allowed by the Legifrance quota.
+
+    Each request to Legifrance either fetches a page of search results for a
+    filter or downloads a text. The scheduler keeps a small number of requests
+    outstanding, so that the agent in charge of Legifrance never idles while
+    each decision is taken as late as possible. It favours text downloads,
+    which feed the parsing and the database, and only fetches a search page
+    when the CIDs queued or being checked by the database fall under a
+    lookahead threshold, or when no download is possible. Search pages are
+    fetched in turn for each search.
+    
+    A search MAY be restricted to a window of publication dates. If the first
+    page of a window announces more results than a few pages can hold, the
+    window is split in two halves to be searched independently, so that each
+    window is short, restartable, and can be interleaved with the others.
+    Searches without a window are never split.
+
+    Methods
+    -------
+    addSearch(criteria, window)
+        Register a search whose results must be fetched.
+    pageDone(criteria, window, isLast, total, count)
+        Record the reception of a page of search results.
+    searching()
+        Check if search results remain to be fetched.
+    checkStarted(count), checkDone(count)
+        Record the start and end of an existence check in the database.
+    addDownloads(cids)
+        Queue texts to download.
+    textDone()
+        Record the reception of a text.
+    stored(count)
+        Record the storage of texts in the database.
+    next()
+        Choose the next request to send to Legifrance.
+    expectsTexts()
+        Check if more texts are about to be received.
+    """
+    def __init__(self, depth=2, lookahead=20, maxInFlight=None, 
+                 windowPages=None):
+        """
+        Create a scheduler with no search to run.
+
+        Parameters
+        ----------
+        depth : int, optional
+            Number of requests kept outstanding. The default is 2.
+        lookahead : int, optional
+            Number of CIDs waiting to be downloaded or checked below which a
+            new page of search results is fetched. The default is 20.
+        maxInFlight : int, optional
+            Maximum number of texts downloaded or being downloaded and not yet
+            stored in the database. If None, there is no limit.
+            The default is None.
+        windowPages : int, optional
+            Maximum number of pages of results per window of publication 
+            dates, above which the window is split. If None, windows are never
+            split. The default is None.
+        """
+        self._depth = depth
+        self._lookahead = lookahead
+        self._maxInFlight = maxInFlight
+        self._windowPages = windowPages
+        #Searches, i.e. (filter, window) tuples, with more pages to fetch and
+        #no page being fetched, in turn
+        self._searches = deque()
+        #Next page to fetch for each search with more pages
+        self._pages = dict()
+        self._downloads = deque()
+        self._outstanding = 0
+        self._downloading = 0
+        self._checking = 0
+        self._inFlight = 0
+
+    def addSearch(self, criteria, window=None):
+        """
+        Register a search whose results must be fetched.
+
+        Parameters
+        ----------
+        criteria : SearchFilters
+            The filter.
+        window : tuple, optional
+            If provided, the search is restricted to texts published between 
+            the two dates of the tuple, included, as "YYYY-MM-DD" str.
+            The default is None.
+
+        Returns
+        -------
+        None.
+        """
+        self._pages[(criteria, window)] = 1
+        self._searches.append((criteria, window))
+
+    def pageDone(self, criteria, window, isLast, total, count):
+        """
+        Record the reception of a page of search results.
+
+        Parameters
+        ----------
+        criteria : SearchFilters
+            Filter of the page.
+        window : tuple or None
+            Window of publication dates of the page.
+        isLast : bool
+            True iff there is no more page to fetch for the search.
+        total : int
+            Total number of results of the search.
+        count : int
+            Number of results in the page.
+
+        Returns
+        -------
+        list or None
+            None if the results of the page are to be used. Otherwise, the 
+            search has been split: the page MUST be discarded, and the 
+            returned list contains the two windows that replace this one; they
+            are not registered as searches.
+        """
+        self._outstanding -= 1
+        search = (criteria, window)
+        if self._pages[search] == 2 and window is not None and not isLast \
+                and self._windowPages is not None \
+                and total > self._windowPages * count:
+            start, end = date.fromisoformat(window[0]), \
+                date.fromisoformat(window[1])
+            if start < end:
+                self._pages.pop(search)
+                middle = start + (end - start) // 2
+                return [(window[0], middle.isoformat()),
+                        ((middle + timedelta(days=1)).isoformat(), window[1])]
+        if isLast:
+            self._pages.pop(search)
+        else:
+            self._searches.append(search)
+        return None
+
+    def searching(self):
+        """Check if search results remain to be fetched."""
+        return bool(self._pages)
+
+    def checkStarted(self, count):
+        """Record that count CIDs are being checked by the database."""
+        self._checking += count
+
+    def checkDone(self, count):
+        """Record that the check of count CIDs by the database is over."""
+        self._checking -= count
+
+    def addDownloads(self, cids):
+        """
+        Queue texts to download.
+
+        Parameters
+        ----------
+        cids : list of str
+            CIDs of the texts.
+
+        Returns
+        -------
+        None.
+        """
+        self._downloads.extend(cids)
+
+    def textDone(self):
+        """Record the reception of a text."""
+        self._outstanding -= 1
+        self._downloading -= 1
+
+    def stored(self, count=1):
+        """Record that count texts have been stored in the database."""
+        self._inFlight -= count
+
+    def _canDownload(self):
+        """Check if a text can be downloaded now."""
+        return bool(self._downloads) and (self._maxInFlight is None or
+                                          self._inFlight < self._maxInFlight)
+
+    def next(self):
+        """
+        Choose the next request to send to Legifrance.
+
+        The request is considered sent when this method returns it.
+
+        Returns
+        -------
+        tuple or None
+            None if no request should be sent now. Otherwise, either
+            ("page", filter, page number, window) to fetch a page of search 
+            results or ("text", cid) to download a text.
+        """
+        if self._outstanding >= self._depth:
+            return None
+        starving = len(self._downloads) + self._checking < self._lookahead
+        if self._searches and (starving or not self._canDownload()):
+            search = self._searches.popleft()
+            page = self._pages[search]
+            self._pages[search] = page + 1
+            self._outstanding += 1
+            return ("page", search[0], page, search[1])
+        if self._canDownload():
+            self._outstanding += 1
+            self._downloading += 1
+            self._inFlight += 1
+            return ("text", self._downloads.popleft())
+        return None
+
+    def expectsTexts(self):
+        """
+        Check if more texts are about to be received.
+
+        Returns
+        -------
+        bool
+            True iff a text is being downloaded or can be downloaded now.
+        """
+        return bool(self._downloading) or self._canDownload()
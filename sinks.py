@@ -0,0 +1,522 @@
+# -*- coding: utf-8 -*-
+"""
+Provide the destinations where the parsing results can be stored.
+
+Classes
+-------
+Sink
+    Interface of the destinations of the parsing results.
+PostgresSink
+    Store the parsing results in the PostgreSQL database.
+ParquetSink
+    Store the parsing results in Parquet files, partitioned by publication
+    month.
+"""
+from abc import ABC, abstractmethod
+import os, time
+from datetime import datetime, timezone
+from uuid import uuid4
+from dbStructure import Types, Statements, prepareStatements
+
+class Sink(ABC):
+    """
+    Interface of the destinations of the parsing results.
+
+    Objects of this class MUST be used as context managers: the destination is
+    only opened when entering the with-block. Until then, the object MUST be
+    picklable so that it can be sent to the process in charge of the storage.
+    Subclasses MUST implement the abstract methods: an incomplete sink fails
+    when it is created rather than during a crawl.
+
+    Methods
+    -------
+    knownCids()
+        List the CIDs of all the texts already stored.
+    isKnown(cid)
+        Check if a text is already stored.
+    insertFailed(cids)
+        Store texts that could not be parsed.
+    insertParsed(texts)
+        Store parsed texts and their records.
+    insertVersions(texts)
+        Store the version of the parsing of texts.
+    staleTexts(fingerprints)
+        List the texts parsed with other versions of the structures.
+    deleteTexts(cids)
+        Delete the stored results of texts.
+    commit()
+        Make the pending insertions durable.
+    flush()
+        Make all the pending insertions durable, even if buffered.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+    def knownCids(self):
+        """
+        List the CIDs of all the texts already stored.
+
+        Returns
+        -------
+        list or None
+            CIDs of the parsed and failed texts, or None if the sink cannot
+            list them.
+        """
+        return None
+
+    @abstractmethod
+    def isKnown(self, cid):
+        """
+        Check if a text is already stored.
+
+        Parameters
+        ----------
+        cid : str
+            CID of the text to check.
+
+        Returns
+        -------
+        bool
+            True iff the text is already stored as parsed or failed.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def insertFailed(self, cids):
+        """
+        Store texts that could not be parsed.
+
+        Parameters
+        ----------
+        cids : list of str
+            CIDs of the texts.
+
+        Returns
+        -------
+        None.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def insertParsed(self, texts):
+        """
+        Store parsed texts and their records.
+
+        Parameters
+        ----------
+        texts : list of dict
+            Each element MUST have keys Types.cid, Types.publicationDate (int)
+            and "data", itself a list with the values ordered as required by
+            Statements.insertRecord.
+
+        Returns
+        -------
+        None.
+        """
+        raise NotImplementedError
+
+    def insertVersions(self, texts):
+        """
+        Store the version of the parsing of texts.
+        
+        The sinks that do not support versions MAY ignore them.
+
+        Parameters
+        ----------
+        texts : list of dict
+            Each element MUST have keys Types.cid, "filter" (name of the 
+            filter), "fingerprint" and "contentHash" (str or None).
+
+        Returns
+        -------
+        None.
+        """
+        pass
+
+    @abstractmethod
+    def staleTexts(self, fingerprints):
+        """
+        List the texts parsed with other versions of the structures.
+        
+        Only the texts stored with their version (see insertVersions) are
+        listed: the texts stored before versions were recorded are ignored.
+        Sinks that cannot delete texts MUST raise NotImplementedError here,
+        before any text is downloaded again.
+
+        Parameters
+        ----------
+        fingerprints : dict
+            Current fingerprint associated with the name of each filter to
+            consider.
+
+        Returns
+        -------
+        list of tuples
+            (CID, name of the filter) of each text of the filters whose stored
+            fingerprint differs from the current one, whether it was 
+            successfully parsed or not.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def deleteTexts(self, cids):
+        """
+        Delete the stored results of texts, so that they can be stored again.
+
+        Parameters
+        ----------
+        cids : list of str
+            CIDs of the texts.
+
+        Returns
+        -------
+        None.
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        """Make the pending insertions durable."""
+        pass
+
+    def flush(self):
+        """
+        Make all the pending insertions durable, even if the sink buffers
+        them until a later commit, e.g. at the end of a job of a daemon.
+        """
+        self.commit()
+
+class PostgresSink(Sink):
+    """
+    Store the parsing results in the PostgreSQL database.
+
+    If the records table is partitioned by publication date, the partitions
+    of the stored texts are created before their records are inserted, and the
+    publication date of each record is filled in if Statements.insertRecord
+    expects it and the parser left it empty.
+    
+    The versions of the parsing are stored in a textVersions table, created
+    if necessary. Deleting texts requires dbStructure to define a deleteText
+    statement, taking a CID as argument.
+    """
+    _VERSIONS = ("CREATE TABLE IF NOT EXISTS textVersions ("
+                 "cid TEXT PRIMARY KEY, filter TEXT NOT NULL, "
+                 "fingerprint TEXT NOT NULL, contentHash TEXT)")
+    _UPSERT_VERSION = ("INSERT INTO textVersions VALUES ($1, $2, $3, $4) "
+                       "ON CONFLICT (cid) DO UPDATE SET filter = $2, "
+                       "fingerprint = $3, contentHash = $4")
+    def __init__(self, *args, partitions=None):
+        """
+        Create a sink ready to connect to the database.
+
+        Parameters
+        ----------
+        *args
+            Arguments to create a DbConnector object.
+        partitions : PartitionScheme, optional
+            Partitioning of the records table, as set up by 
+            PartitionScheme.partitionTable. The default is None.
+        """
+        self._args = args
+        self._partitions = partitions
+        self._connector = None
+
+    def __enter__(self):
+        #psycopg2 is only imported by the processes using the database
+        from dbConnector import DbConnector
+        self._connector = DbConnector(*self._args).__enter__()
+        prepareStatements(self._connector)
+        self._connector.execute(self._VERSIONS)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self._connector.__exit__(exc_type, exc_value, exc_traceback)
+        self._connector = None
+
+    def knownCids(self):
+        """
+        List the CIDs of all the texts already stored.
+
+        This requires dbStructure to define a selectKnownCids statement.
+
+        Returns
+        -------
+        list or None
+            CIDs of the parsed and failed texts, or None if the statement is
+            not defined.
+        """
+        if "selectKnownCids" not in Statements.__members__:
+            return None
+        rows = self._connector.executeAndFetch(
+            Statements.selectKnownCids.query)
+        return [row[0] for row in rows]
+
+    def isKnown(self, cid):
+        return self._connector.executeAndFetch(Statements.selectCid.query,
+                                               (cid,))[0][0]
+
+    def insertFailed(self, cids):
+        self._connector.executeMany(Statements.insertFailed.query,
+                                    [(x,) for x in cids])
+
+    def insertParsed(self, texts):
+        self._connector.executeMany(Statements.insertParsed.query,
+            [(x[Types.cid], x[Types.publicationDate]) for x in texts])
+        if self._partitions is not None:
+            self._partitions.ensurePartitions(self._connector,
+                {x[Types.publicationDate] for x in texts})
+            self._fillDates(texts)
+        self._connector.executeMany(Statements.insertRecord.query,
+                                    [y for x in texts for y in x["data"]])
+
+    def _fillDates(self, texts):
+        """
+        Fill in the publication date of the records where it is missing.
+
+        Parameters
+        ----------
+        texts : list of dict
+            Texts as given to insertParsed. Their records are modified in 
+            place.
+
+        Returns
+        -------
+        None.
+        """
+        names = [arg.name for arg in Statements.insertRecord.args]
+        if self._partitions.column not in names:
+            return None
+        index = names.index(self._partitions.column)
+        for text in texts:
+            value = self._partitions.value(self._connector,
+                                           text[Types.publicationDate])
+            for i, row in enumerate(text["data"]):
+                if row[index] is None:
+                    row = list(row)
+                    row[index] = value
+                    text["data"][i] = row
+
+    def insertVersions(self, texts):
+        self._connector.executeMany(self._UPSERT_VERSION,
+            [(x[Types.cid], x["filter"], x["fingerprint"], x["contentHash"])
+             for x in texts])
+
+    def staleTexts(self, fingerprints):
+        #Fail before the stale texts are downloaded again
+        self._checkDeletable()
+        result = []
+        for name, fingerprint in fingerprints.items():
+            result.extend((row[0], row[1]) for row in 
+                          self._connector.executeAndFetch(
+                              "SELECT cid, filter FROM textVersions "
+                              "WHERE filter = %s AND fingerprint <> %s",
+                              (name, fingerprint)))
+        return result
+
+    def deleteTexts(self, cids):
+        self._checkDeletable()
+        self._connector.executeMany(Statements.deleteText.query,
+                                    [(x,) for x in cids])
+
+    def _checkDeletable(self):
+        """Check that dbStructure defines the statement deleting a text."""
+        if "deleteText" not in Statements.__members__:
+            raise NotImplementedError(
+                "dbStructure does not define a deleteText statement")
+
+    def commit(self):
+        self._connector.commit()
+
+class ParquetSink(Sink):
+    """
+    Store the parsing results in Parquet files, partitioned by publication
+    month.
+
+    The results are written in three subdirectories of the output directory:
+    "parsed" (columns cid and publicationDate), "failed" (column cid) and
+    "records", where the columns are named after Statements.insertRecord.args
+    and the files are split in subdirectories "publicationMonth=YYYY-MM"
+    readable as a partitioned dataset.
+    Rows are buffered and written in large batches, or when flushed: the 
+    results of a crashed run MAY be lost since the last batch. Several sinks MAY write in the same
+    directory as each batch is written in a new file.
+    The versions of the parsing are written in a fourth subdirectory, 
+    "versions", with a column storedAt: the latest version of each text is
+    the current one. Deleting texts rewrites the files containing them when
+    the next batch is written.
+
+    This sink requires the pyarrow package.
+    """
+    _PARSED = "parsed"
+    _FAILED = "failed"
+    _RECORDS = "records"
+    _VERSIONS = "versions"
+    _VERSION_COLUMNS = [Types.cid.name, "filter", "fingerprint", "contentHash",
+                        "storedAt"]
+    def __init__(self, directory, batchSize=100000):
+        """
+        Create a sink ready to write in a directory.
+
+        Parameters
+        ----------
+        directory : str
+            Path to the output directory. It will be created if necessary.
+        batchSize : int, optional
+            Number of buffered records above which they are written to disk.
+            The default is 100000.
+        """
+        self._directory = directory
+        self._batchSize = batchSize
+        self._known = set()
+        self._failed = []
+        self._parsed = []
+        self._records = dict()
+        self._recordNumber = 0
+        self._versions = []
+        #CIDs whose rows already written MUST be removed
+        self._deleted = set()
+
+    def __enter__(self):
+        import pyarrow.parquet as pq
+        for name in (self._PARSED, self._FAILED, self._RECORDS, 
+                     self._VERSIONS):
+            os.makedirs(os.path.join(self._directory, name), exist_ok=True)
+        for name in (self._PARSED, self._FAILED):
+            path = os.path.join(self._directory, name)
+            for file in os.listdir(path):
+                if file.endswith(".parquet"):
+                    self._known.update(pq.read_table(os.path.join(path, file),
+                        columns=[Types.cid.name]).column(0).to_pylist())
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self._flush()
+
+    def knownCids(self):
+        return list(self._known)
+
+    def isKnown(self, cid):
+        return cid in self._known
+
+    def insertFailed(self, cids):
+        self._failed.extend(cids)
+        self._known.update(cids)
+
+    def insertParsed(self, texts):
+        for text in texts:
+            self._parsed.append((text[Types.cid],
+                                 text[Types.publicationDate]))
+            self._known.add(text[Types.cid])
+            month = datetime.fromtimestamp(text[Types.publicationDate],
+                                           timezone.utc).strftime("%Y-%m")
+            self._records.setdefault(month, []).extend(text["data"])
+            self._recordNumber += len(text["data"])
+
+    def insertVersions(self, texts):
+        now = time.time()
+        self._versions.extend((x[Types.cid], x["filter"], x["fingerprint"],
+                               x["contentHash"], now) for x in texts)
+
+    def staleTexts(self, fingerprints):
+        import pyarrow.parquet as pq
+        latest = dict()
+        path = os.path.join(self._directory, self._VERSIONS)
+        rows = []
+        for file in os.listdir(path):
+            if file.endswith(".parquet"):
+                rows.extend(zip(*(column.to_pylist() for column in 
+                                  pq.read_table(os.path.join(path, file), 
+                                      columns=self._VERSION_COLUMNS).columns)))
+        for row in rows + self._versions:
+            if row[0] not in latest or latest[row[0]][4] <= row[4]:
+                latest[row[0]] = row
+        return [(row[0], row[1]) for row in latest.values()
+                if row[1] in fingerprints and row[2] != fingerprints[row[1]]]
+
+    def deleteTexts(self, cids):
+        cids = set(cids)
+        self._deleted.update(cids)
+        self._failed = [x for x in self._failed if x not in cids]
+        self._parsed = [x for x in self._parsed if x[0] not in cids]
+        index = [arg.name for arg in 
+                 Statements.insertRecord.args].index(Types.cid.name)
+        for month, rows in self._records.items():
+            kept = [x for x in rows if x[index] not in cids]
+            self._recordNumber -= len(rows) - len(kept)
+            self._records[month] = kept
+
+    def commit(self):
+        """Write the buffered rows if there are enough of them."""
+        if self._recordNumber + len(self._failed) >= self._batchSize:
+            self._flush()
+
+    def flush(self):
+        self._flush()
+
+    def _write(self, directory, names, rows):
+        """
+        Write rows in a new Parquet file.
+
+        Parameters
+        ----------
+        directory : str
+            Directory of the file, relative to the output directory.
+        names : list of str
+            Names of the columns.
+        rows : list of tuples
+            Each element has one value per column.
+
+        Returns
+        -------
+        None.
+        """
+        if not rows:
+            return None
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        path = os.path.join(self._directory, directory)
+        os.makedirs(path, exist_ok=True)
+        table = pa.Table.from_pydict({name: [row[i] for row in rows]
+                                      for i, name in enumerate(names)})
+        pq.write_table(table, os.path.join(path,
+                                           "part-{}.parquet".format(uuid4())))
+
+    def _purge(self):
+        """Rewrite the files containing rows of deleted texts without them."""
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        deleted = pa.array(list(self._deleted), pa.string())
+        for directory in (self._PARSED, self._FAILED, self._RECORDS):
+            for root, _, files in os.walk(os.path.join(self._directory, 
+                                                       directory)):
+                for file in files:
+                    if not file.endswith(".parquet"):
+                        continue
+                    path = os.path.join(root, file)
+                    table = pq.read_table(path)
+                    mask = pc.is_in(table.column(Types.cid.name), 
+                                    value_set=deleted)
+                    if pc.any(mask).as_py():
+                        pq.write_table(table.filter(pc.invert(mask)), path)
+        self._deleted = set()
+
+    def _flush(self):
+        """Write all the buffered rows to disk."""
+        if self._deleted:
+            self._purge()
+        self._write(self._FAILED, [Types.cid.name],
+                    [(x,) for x in self._failed])
+        self._write(self._PARSED,
+                    [Types.cid.name, Types.publicationDate.name], self._parsed)
+        names = [arg.name for arg in Statements.insertRecord.args]
+        for month, rows in self._records.items():
+            self._write(os.path.join(self._RECORDS,
+                                     "publicationMonth=" + month),
+                        names, rows)
+        self._write(self._VERSIONS, self._VERSION_COLUMNS, self._versions)
+        self._failed, self._parsed, self._records = [], [], dict()
+        self._recordNumber = 0
+        self._versions = []